@@ -0,0 +1,77 @@
+""" Benchmarks the CloudFormation macro template walker on the largest templates in this repo.
+
+USAGE:
+  python benchmark_macro.py [number_of_templates] [iterations]
+
+EXAMPLES:
+  python benchmark_macro.py
+  python benchmark_macro.py 5 200
+
+  Each template is walked with all transforms registered in lambda/macro/lambda_function.py.
+  No AWS calls are made: PhoenixSSM paths are collected by the walk but never fetched, and
+  templates containing PhoenixS3Transform references are skipped.
+"""
+
+__author__ = "Jason DeBolt (jasondebolt@gmail.com)"
+
+import os
+import sys
+import glob
+import json
+import copy
+import time
+
+from macro_expand import PHOENIX_DIR, load_macro_module, _parse_json
+
+
+def get_largest_templates(count):
+    templates = [path for path in glob.glob(os.path.join(PHOENIX_DIR, 'template-*.json'))
+                 if 'params' not in path]
+    return sorted(templates, key=os.path.getsize, reverse=True)[:count]
+
+
+def get_params_map(template, project_name):
+    # Interpolate PhoenixSSM paths with the template's parameter defaults.
+    params_map = {key: value.get('Default', key)
+                  for key, value in template.get('Parameters', {}).items()}
+    params_map['ProjectName'] = project_name
+    return params_map
+
+
+def benchmark_template(macro, path, iterations):
+    try:
+        template = _parse_json(path)
+    except ValueError as e:
+        return {'template': os.path.basename(path), 'error': 'invalid JSON: {0}'.format(e)}
+    if 'PhoenixS3Transform' in json.dumps(template):
+        return {'template': os.path.basename(path), 'error': 'skipped, contains PhoenixS3Transform'}
+
+    params_map = get_params_map(template, macro.PROJECT_NAME)
+    timings = []
+    for _ in range(iterations):
+        fragment = copy.deepcopy(template)
+        context = macro.new_transform_context(params_map)
+        start = time.perf_counter()
+        macro.walk_template(fragment, context)
+        timings.append(time.perf_counter() - start)
+
+    return {
+        'template': os.path.basename(path),
+        'bytes': os.path.getsize(path),
+        'phoenix_ssm_refs': len(context['ssm_slots']),
+        'distinct_ssm_paths': len(set(slot[2] for slot in context['ssm_slots'])),
+        'best_ms': round(min(timings) * 1000, 3),
+        'mean_ms': round(sum(timings) / len(timings) * 1000, 3),
+    }
+
+
+def main(args):
+    count = int(args[0]) if len(args) > 0 else 5
+    iterations = int(args[1]) if len(args) > 1 else 100
+    macro = load_macro_module()
+    for path in get_largest_templates(count):
+        print(json.dumps(benchmark_template(macro, path, iterations)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,152 @@
+""" Benchmarks GitHub webhook event parsing in the pull request and release webhook Lambdas.
+
+Compares the original parsing (the event is dumped and reloaded into JSONObject instances,
+the body is parsed into JSONObject instances, and every stage is printed) with the handlers'
+parse_pull_request_event/parse_push_event, which parse the raw body once and keep only the
+fields the handlers use. Both sides include the HMAC signature check on the raw body.
+
+USAGE:
+  python benchmark_webhook_parsing.py [iterations]
+
+EXAMPLES:
+  python benchmark_webhook_parsing.py
+  python benchmark_webhook_parsing.py 500
+
+  Payloads are read from the fixtures directory. No AWS or GitHub calls are made.
+"""
+
+__author__ = "Jason DeBolt (jasondebolt@gmail.com)"
+
+import os
+import io
+import sys
+import json
+import hmac
+import time
+import contextlib
+import importlib.util
+
+PHOENIX_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(PHOENIX_DIR, 'fixtures')
+SECRET = 'benchmark-secret'
+
+
+class JSONObject:
+  def __init__(self, dict):
+      vars(self).update(dict)
+
+
+def load_handler(name):
+    # Both Lambdas are named lambda_function, so each is loaded under its own module name.
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    lambda_dir = os.path.join(PHOENIX_DIR, 'lambda', name)
+    for path in (lambda_dir, os.path.join(PHOENIX_DIR, 'lambda', 'shared')):
+        if path not in sys.path:
+            sys.path.append(path)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(lambda_dir, 'lambda_function.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def get_event(fixture_name, github_event):
+    body = open(os.path.join(FIXTURES_DIR, fixture_name), 'r').read()
+    signature = 'sha1=' + hmac.new(SECRET.encode(), body.encode(), 'sha1').hexdigest()
+    return {
+        'resource': '/github',
+        'path': '/github',
+        'httpMethod': 'POST',
+        'headers': {
+            'X-GitHub-Event': github_event,
+            'X-GitHub-Delivery': '72d3162e-cc78-11e3-81ab-4c9367dc0958',
+            'X-Hub-Signature': signature,
+            'Content-Type': 'application/json',
+        },
+        'isBase64Encoded': False,
+        'body': body,
+    }
+
+
+def is_valid_signature(event):
+    signature = hmac.new(SECRET.encode(), event['body'].encode(), 'sha1')
+    return hmac.compare_digest(event['headers']['X-Hub-Signature'], 'sha1=' + signature.hexdigest())
+
+
+def legacy_parse(event):
+    assert is_valid_signature(event)
+    print('EVENT:')
+    print(event)
+    json_obj = json.dumps(event, indent=4)
+    print('JSON_OBJECT:')
+    print(json_obj)
+    obj = json.loads(json_obj, object_hook=JSONObject)
+    print('OBJECT:')
+    print(obj)
+    body = json.loads(obj.body, object_hook=JSONObject)
+    print('BODY:')
+    print(body)
+    return body
+
+
+def lean_parse(handler, parse_function, event):
+    raw_body = handler.get_raw_body(event)
+    signature = hmac.new(SECRET.encode(), raw_body, 'sha1')
+    assert hmac.compare_digest(event['headers']['X-Hub-Signature'], 'sha1=' + signature.hexdigest())
+    print('Received {0} event, delivery {1}'.format(
+        event['headers'].get('X-GitHub-Event'), event['headers'].get('X-GitHub-Delivery')))
+    return parse_function(raw_body)
+
+
+def time_function(function, iterations):
+    timings = []
+    # The handlers' prints go to CloudWatch, so they are part of the cost, but not of this output.
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        for _ in range(iterations):
+            start = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start)
+            output.seek(0)
+            output.truncate()
+    return timings
+
+
+def benchmark(name, event, legacy_function, lean_function, iterations):
+    legacy = time_function(legacy_function, iterations)
+    lean = time_function(lean_function, iterations)
+    return {
+        'event': name,
+        'body_bytes': len(event['body']),
+        'legacy_best_ms': round(min(legacy) * 1000, 3),
+        'legacy_mean_ms': round(sum(legacy) / len(legacy) * 1000, 3),
+        'lean_best_ms': round(min(lean) * 1000, 3),
+        'lean_mean_ms': round(sum(lean) / len(lean) * 1000, 3),
+        'speedup': round(sum(legacy) / sum(lean), 1),
+    }
+
+
+def main(args):
+    iterations = int(args[0]) if len(args) > 0 else 200
+    pull_request_webhook = load_handler('pull_request_webhook')
+    release_webhook = load_handler('release_webhook')
+
+    event = get_event('github-pull-request-event.json', 'pull_request')
+    parsed = pull_request_webhook.parse_pull_request_event(pull_request_webhook.get_raw_body(event))
+    assert parsed['source_branch'] == json.loads(event['body'])['pull_request']['head']['ref']
+    print(json.dumps(benchmark(
+        'pull_request', event,
+        lambda: legacy_parse(event),
+        lambda: lean_parse(pull_request_webhook, pull_request_webhook.parse_pull_request_event, event),
+        iterations)))
+
+    event = get_event('github-push-event.json', 'push')
+    parsed = release_webhook.parse_push_event(release_webhook.get_raw_body(event))
+    assert parsed['after'] == json.loads(event['body'])['after']
+    print(json.dumps(benchmark(
+        'push', event,
+        lambda: legacy_parse(event),
+        lambda: lean_parse(release_webhook, release_webhook.parse_push_event, event),
+        iterations)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
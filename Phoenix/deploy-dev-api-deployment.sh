@@ -40,6 +40,7 @@ listOfLambdaFunctions='api_internals'
 for functionName in $listOfLambdaFunctions
 do
   mkdir -p builds/$functionName
+  cp -rf lambda/shared/* builds/$functionName/
   cp -rf lambda/$functionName/* builds/$functionName/
   cd builds/$functionName/
   pip install -r requirements.txt -t .
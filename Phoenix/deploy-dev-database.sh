@@ -38,6 +38,7 @@ listOfPythonLambdaFunctions='password_generator'
 for functionName in $listOfPythonLambdaFunctions
 do
   mkdir -p builds/$functionName
+  cp -rf lambda/shared/* builds/$functionName/
   cp -rf lambda/$functionName/* builds/$functionName/
   cd builds/$functionName/
   pip install -r requirements.txt -t .
@@ -40,6 +40,7 @@ listOfPythonLambdaFunctions='projects delete_network_interface alb_listener_rule
 for functionName in $listOfPythonLambdaFunctions
 do
   mkdir -p builds/$functionName
+  cp -rf lambda/shared/* builds/$functionName/
   cp -rf lambda/$functionName/* builds/$functionName/
   cd builds/$functionName/
   pip install -r requirements.txt -t .
@@ -39,6 +39,7 @@ listOfLambdaFunctions='pull_request_webhook create_pull_request_webhook post_pul
 for functionName in $listOfLambdaFunctions
 do
   mkdir -p builds/$functionName
+  cp -rf lambda/shared/* builds/$functionName/
   cp -rf lambda/$functionName/* builds/$functionName/
   cd builds/$functionName/
   pip install -r requirements.txt -t .
@@ -39,6 +39,7 @@ listOfLambdaFunctions='release_webhook create_release_webhook'
 for functionName in $listOfLambdaFunctions
 do
   mkdir -p builds/$functionName
+  cp -rf lambda/shared/* builds/$functionName/
   cp -rf lambda/$functionName/* builds/$functionName/
   cd builds/$functionName/
   pip install -r requirements.txt -t .
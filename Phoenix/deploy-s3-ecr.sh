@@ -42,6 +42,7 @@ listOfPythonLambdaFunctions='delete_s3_files delete_ecr_repos'
 for functionName in $listOfPythonLambdaFunctions
 do
   mkdir -p builds/$functionName
+  cp -rf lambda/shared/* builds/$functionName/
   cp -rf lambda/$functionName/* builds/$functionName/
   cd builds/$functionName/
   pip install -r requirements.txt -t .
@@ -27,6 +27,7 @@ listOfPythonLambdaFunctions='macro ssm_secret delete_network_interface'
 for functionName in $listOfPythonLambdaFunctions
 do
   mkdir -p builds/$functionName
+  cp -rf lambda/shared/* builds/$functionName/
   cp -rf lambda/$functionName/* builds/$functionName/
   cd builds/$functionName/
   pip install -r requirements.txt -t .
@@ -16,29 +16,7 @@ from botocore.exceptions import ClientError, ParamValidationError
 import sys
 import os
 import json
-import requests
-from requests import Request, Session
-
-
-def send_response(event, context, response_status, response_data):
-    """Send a Success or Failure event back to CFN stack"""
-
-    print('response_status: ' + response_status)
-    print('response_data: ' + json.dumps(response_data))
-
-    payload = {
-        'StackId': event['StackId'],
-        'Status' : response_status,
-        'Reason': 'See the details in CloudWatch Log Stream: ' + context.log_stream_name,
-        'PhysicalResourceId': context.log_stream_name,
-        'RequestId': event['RequestId'],
-        'LogicalResourceId': event['LogicalResourceId'],
-        'Data': response_data
-    }
-
-    print('Sending %s to %s' % (json.dumps(payload), event['ResponseURL']))
-    requests.put(event['ResponseURL'], data=json.dumps(payload))
-    print('Sent %s to %s' % (json.dumps(payload), event['ResponseURL']))
+from cfn_response import send_response
 
 
 def lambda_handler(event, context):
@@ -90,7 +68,11 @@ def lambda_handler(event, context):
         print('Error:', sys.exc_info()[0])
         response_status = 'FAILED'
 
-    return send_response(event, context, response_status, response_data)
+    print('response_status: ' + response_status)
+    print('response_data: ' + json.dumps(response_data))
+    return send_response(event, context, response_status, response_data,
+                         'See the details in CloudWatch Log Stream: ' + context.log_stream_name,
+                         physical_resource_id=context.log_stream_name)
 
 def create_rule(alb, listener_arn, conditions, priority, actions):
     print('create_rule ' + listener_arn)
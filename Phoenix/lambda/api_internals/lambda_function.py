@@ -2,9 +2,8 @@ import boto3
 import sys
 import json
 import copy
-import uuid
-import requests
 import airspeed
+import custom_resource
 
 # Adds/updates finishing touches to an API Gateway API.
 # This Lambda function is invoked by the API Internals CloudFormation stack.
@@ -132,26 +131,6 @@ def get_application_form_urlencoded(hostname, port):
 client = boto3.client('apigateway')
 
 
-def send_response(event, context, response_status, response_data, reason):
-    """Send a Success or Failure event back to CFN stack"""
-
-    payload = {
-        'StackId': event['StackId'],
-        'Status' : response_status,
-        'Reason' : reason,
-        'RequestId': event['RequestId'],
-        'LogicalResourceId': event['LogicalResourceId'],
-        'Data': response_data
-    }
-
-    payload['PhysicalResourceId'] = event.get(
-        'PhysicalResourceId', str(uuid.uuid4()))
-
-    print("Sending %s to %s" % (json.dumps(payload), event['ResponseURL']))
-    requests.put(event['ResponseURL'], data=json.dumps(payload))
-    print("Sent %s to %s" % (json.dumps(payload), event['ResponseURL']))
-
-
 def get_resource_methods(rest_api_id):
     resources_response = client.get_resources(
         restApiId=rest_api_id,
@@ -166,19 +145,22 @@ def get_resource_methods(rest_api_id):
     return items
 
 
-def lambda_handler(event, context):
-    print(json.dumps(event, indent=2))
-    response_data = {}
+def update_integrations(event, checkpoint, has_time):
+    """Adds the body mapping templates to the VPC proxy integrations.
+
+    Returns the resource methods left if the function is about to time out.
+    """
     lambda_version = event['ResourceProperties']['LambdaVersion']
     hostname = event['ResourceProperties']['Hostname']
     port = event['ResourceProperties']['Port']
     rest_api_id = event['ResourceProperties']['RestApiId']
-    reason = 'N/A'
-    resource_methods = get_resource_methods(rest_api_id)
+    resource_methods = get_resource_methods(rest_api_id) if checkpoint is None else checkpoint
 
     print('Lambda Version: {0}'.format(lambda_version))
     print(resource_methods)
-    for resource_method in resource_methods:
+    while resource_methods and has_time():
+        resource_method = resource_methods[0]
+        resource_methods = resource_methods[1:]
         resource_id = resource_method['id']
         http_method = resource_method['method']
         method_response = client.get_method(
@@ -230,4 +212,9 @@ def lambda_handler(event, context):
                         ]
                     )
 
-    return send_response(event, context, 'SUCCESS', response_data, reason)
+    return {}, resource_methods or None
+
+
+def lambda_handler(event, context):
+    print(json.dumps(event, indent=2))
+    custom_resource.run(event, context, update_integrations)
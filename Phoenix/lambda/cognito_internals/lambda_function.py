@@ -1,37 +1,15 @@
 """ Make various Cognito API and Route53 calls to further configure Cognito User Pools."""
 import json
 import logging
-import uuid
 import string
 import random
-import requests
 import boto3
 import botocore
-from requests import Request, Session
+import custom_resource
 
 cognito_client = boto3.client('cognito-idp')
 route53_client = boto3.client('route53')
 
-def send_response(event, context, response_status, response_data, reason):
-    """Send a Success or Failure event back to CFN stack"""
-
-    payload = {
-        'StackId': event['StackId'],
-        'Status' : response_status,
-        'Reason' : reason,
-        'RequestId': event['RequestId'],
-        'LogicalResourceId': event['LogicalResourceId'],
-        'Data': response_data
-    }
-
-    payload['PhysicalResourceId'] = event.get(
-        'PhysicalResourceId', str(uuid.uuid4()))
-
-    print("Sending %s to %s" % (json.dumps(payload), event['ResponseURL']))
-    requests.put(event['ResponseURL'], data=json.dumps(payload))
-    print("Sent %s to %s" % (json.dumps(payload), event['ResponseURL']))
-
-
 def change_resource_record_set(hosted_zone_id, alias_target_hosted_zone_id, record_set_dns_name, record_set_name, action):
     print('Attempting to {0} auth record set'.format(action))
     try:
@@ -165,11 +143,8 @@ def delete_resource_server(user_pool_id, resource_server_identifier):
     )
     print(response)
 
-def lambda_handler(event, context):
-    response_data = {}
-    reason = 'N/A'
+def configure_user_pool(event, checkpoint, has_time):
     try:
-        print(json.dumps(event, indent=2))
         cognito_domain = event['ResourceProperties']['CognitoDomain'] # {project-name}-{environment}
         api_domain = event['ResourceProperties']['APIDomain']  # api.mosaic-credit.com
         auth_domain = event['ResourceProperties']['AuthDomain']  # auth.api.mosaic-credit.com
@@ -245,7 +220,10 @@ def lambda_handler(event, context):
             print('No-Op. This function should only be used on create, update, and delete stack events.')
     except Exception as e:
         print(e)
-        # Change 'FAILED' to 'SUCCESS' for debugging in line below for debugging this Lambda function.
-        return send_response(event, context, 'SUCCESS', response_data, reason)
+        # Raise the exception here to send a 'FAILED' response for debugging this Lambda function.
 
-    return send_response(event, context, 'SUCCESS', response_data, reason)
+    return {}, None
+
+def lambda_handler(event, context):
+    print(json.dumps(event, indent=2))
+    custom_resource.run(event, context, configure_user_pool)
@@ -2,11 +2,13 @@ import os
 import json
 import boto3
 import botocore
-import requests
 from datetime import datetime
 import urllib.parse
-import uuid
 import hmac
+import collections
+import functools
+from github_client import GitHubClient
+from cfn_response import send_response
 
 # Creates a GitHub webhook within GitHub for sending pull request webhooks
 
@@ -16,27 +18,7 @@ import hmac
 cloudformation_client = boto3.client('cloudformation')
 ssm_client = boto3.client('ssm')
 
-GITHUB_API_URL = 'https://api.github.com'
-
-def send_response(event, context, response_status, response_data, reason):
-    """Send a Success or Failure event back to CFN stack"""
-
-    payload = {
-        'StackId': event['StackId'],
-        'Status' : response_status,
-        'Reason' : reason,
-        'RequestId': event['RequestId'],
-        'LogicalResourceId': event['LogicalResourceId'],
-        'Data': response_data
-    }
-
-    payload['PhysicalResourceId'] = event.get(
-        'PhysicalResourceId', str(uuid.uuid4()))
-
-    print("Sending %s to %s" % (json.dumps(payload, default=str, indent=2), event['ResponseURL']))
-    requests.put(event['ResponseURL'], data=json.dumps(payload, default=str))
-    print("Sent %s to %s" % (json.dumps(payload, default=str, indent=2), event['ResponseURL']))
-
+@functools.lru_cache(maxsize=1)
 def get_github_access_token():
     print('getting github access token')
     response = ssm_client.get_parameter(
@@ -53,12 +35,16 @@ def get_github_pull_request_secret():
     )
     return response['Parameter']['Value']
 
+def refresh_github_access_token():
+    get_github_access_token.cache_clear()
+    return get_github_access_token()
+
+# The access token is read from SSM once per container, and again if GitHub rejects it.
+github = GitHubClient(get_github_access_token, refresh_github_access_token)
+
 def create_webhook(kwargs, repo_name):
-    url = os.path.join(GITHUB_API_URL, 'repos/{0}/{1}/hooks'.format(
-        os.environ['GITHUB_ORGANIZATION'], repo_name))
+    url = 'repos/{0}/{1}/hooks'.format(os.environ['GITHUB_ORGANIZATION'], repo_name)
     # Create a secret token and save to SSM parameter store
-    access_token = get_github_access_token()
-    headers = {'Authorization': 'token {0}'.format(access_token)}
     secret = get_github_pull_request_secret() # Gets the secret from SSM parameter store
     webhook_url = kwargs['config']['url']
     kwargs['name'] = 'web' # This must always be 'web' for webhooks.
@@ -67,50 +53,47 @@ def create_webhook(kwargs, repo_name):
         'content_type': 'json',
         'secret': secret
     }
-    response = requests.post(url, data=json.dumps(kwargs), headers=headers)
+    response = github.post(url, kwargs)
     print(json.dumps(response.json(), indent=2))
 
+def get_webhook_ids_by_url(webhook_api_url):
+    # Indexes every webhook of the repo by URL, across all pages of the hooks API.
+    webhooks = github.get_all(webhook_api_url)
+    print('Found {0} webhooks in {1}'.format(len(webhooks), webhook_api_url))
+    webhook_ids = collections.defaultdict(list)
+    for webhook in webhooks:
+        webhook_ids[webhook['config'].get('url')].append(webhook['id'])
+    return webhook_ids
+
 def update_webhook(kwargs, repo_name):
-    # Deletes all webhooks associated with a given name
+    # Updates all webhooks associated with a given URL
     webhook_api_url = 'repos/{0}/{1}/hooks'.format(
         os.environ['GITHUB_ORGANIZATION'], repo_name)
-    list_url = os.path.join(GITHUB_API_URL, webhook_api_url)
-    access_token = get_github_access_token()
-    headers = {'Authorization': 'token {0}'.format(access_token)}
-    response = requests.get(list_url, headers=headers)
-    print(json.dumps(json.loads(response.text), indent=2, default=str))
-    response_obj = json.loads(response.text)
-    for webhook in response_obj:
-        print('webook: ', webhook)
-        if webhook['config']['url'] == kwargs['config']['url']:
-            secret = get_github_pull_request_secret() # Gets the secret from SSM parameter store
-            kwargs['config'] = {
-                'url': kwargs['config']['url'],
-                'content_type': 'json',
-                'secret': secret
-            }
-            update_url = os.path.join(GITHUB_API_URL, webhook_api_url, str(webhook['id']))
-            print('Updating webhook {0} with id {1}'.format(webhook['config']['url'], webhook['id']))
-            response = requests.patch(update_url, data=json.dumps(kwargs), headers=headers)
-            print(json.dumps(response.json(), indent=2))
+    webhook_url = kwargs['config']['url']
+    webhook_ids = get_webhook_ids_by_url(webhook_api_url).get(webhook_url, [])
+    if not webhook_ids:
+        print('No webhooks found with url {0}'.format(webhook_url))
+        return
+    kwargs['config'] = {
+        'url': webhook_url,
+        'content_type': 'json',
+        'secret': get_github_pull_request_secret() # Gets the secret from SSM parameter store
+    }
+    for webhook_id in webhook_ids:
+        update_url = '{0}/{1}'.format(webhook_api_url, webhook_id)
+        print('Updating webhook {0} with id {1}'.format(webhook_url, webhook_id))
+        response = github.patch(update_url, kwargs)
+        print(json.dumps(response.json(), indent=2))
 
 def delete_webhook(webhook_url, repo_name):
-    # Deletes all webhooks associated with a given name
+    # Deletes all webhooks associated with a given URL
     webhook_api_url = 'repos/{0}/{1}/hooks'.format(
         os.environ['GITHUB_ORGANIZATION'], repo_name)
-    list_url = os.path.join(GITHUB_API_URL, webhook_api_url)
-    access_token = get_github_access_token()
-    headers = {'Authorization': 'token {0}'.format(access_token)}
-    response = requests.get(list_url, headers=headers)
-    print(json.dumps(json.loads(response.text), indent=2, default=str))
-    response_obj = json.loads(response.text)
-    for webhook in response_obj:
-        print('webook: ', webhook)
-        if webhook['config']['url'] == webhook_url:
-            delete_url = os.path.join(GITHUB_API_URL, webhook_api_url, str(webhook['id']))
-            print('Deleting webhook {0} with id {1}'.format(webhook['config']['url'], webhook['id']))
-            response = requests.delete(delete_url, headers=headers)
-            print(response)
+    for webhook_id in get_webhook_ids_by_url(webhook_api_url).get(webhook_url, []):
+        delete_url = '{0}/{1}'.format(webhook_api_url, webhook_id)
+        print('Deleting webhook {0} with id {1}'.format(webhook_url, webhook_id))
+        response = github.delete(delete_url)
+        print(response)
 
 def clean_params(obj, replace_map):
     # Recursive function to set all values to Python types.
@@ -1,60 +1,120 @@
+import os
 import json
 import logging
-import uuid
 import string
 import random
-import requests
 import boto3
-from requests import Request, Session
+import botocore
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+import custom_resource
 
 # This is a CloudFormation Custom Lambda resource that automatically deletes
 # all images in one or more ECR repos, as well as the ECR repo itself. This is
 # particularly useful when deleting ECR repos in CloudFormation since
 # CloudFormation cannot delete non-empty ECR repos.
+#
+# The repos are deleted concurrently. The images of repos with more than DELETE_BATCH_SIZE images are
+# deleted in batches first, so that a large repo can be emptied across invocations (see custom_resource.py)
+# instead of in one long forced delete. Smaller repos are force deleted after a single DescribeImages call,
+# which gives the bytes reclaimed. Repos that don't exist count as deleted.
 
-ecr_client = boto3.client('ecr')
+MAX_WORKERS = int(os.environ.get('PURGE_MAX_WORKERS', '8'))
+DELETE_BATCH_SIZE = 100  # The most image ids a BatchDeleteImage call accepts.
+DESCRIBE_PAGE_SIZE = 1000  # The most images a DescribeImages call returns.
 
-def send_response(event, context, response_status, response_data, reason):
-    """Send a Success or Failure event back to CFN stack"""
+ecr_client = boto3.client('ecr', config=Config(max_pool_connections=MAX_WORKERS))
 
-    payload = {
-        'StackId': event['StackId'],
-        'Status' : response_status,
-        'Reason' : reason,
-        'RequestId': event['RequestId'],
-        'LogicalResourceId': event['LogicalResourceId'],
-        'Data': response_data
-    }
+def describe_images(repo_name):
+    """Returns the first page of images of a repo, or None if the repo doesn't exist."""
+    try:
+        return ecr_client.describe_images(repositoryName=repo_name, maxResults=DESCRIBE_PAGE_SIZE)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'RepositoryNotFoundException':
+            return None
+        raise
 
-    payload['PhysicalResourceId'] = event.get(
-        'PhysicalResourceId', str(uuid.uuid4()))
+def get_images(page):
+    """Returns the image ids and sizes of a describe_images page."""
+    return [{'imageDigest': image['imageDigest'], 'size': image.get('imageSizeInBytes', 0)}
+            for image in page['imageDetails']]
 
-    print("Sending %s to %s" % (json.dumps(payload), event['ResponseURL']))
-    requests.put(event['ResponseURL'], data=json.dumps(payload))
-    print("Sent %s to %s" % (json.dumps(payload), event['ResponseURL']))
+def delete_images(repo_name, images, has_time):
+    """Deletes images in batches while there is time. Returns the images deleted."""
+    deleted = []
+    for index in range(0, len(images), DELETE_BATCH_SIZE):
+        if not has_time():
+            break
+        batch = images[index:index + DELETE_BATCH_SIZE]
+        response = ecr_client.batch_delete_image(
+            repositoryName=repo_name,
+            imageIds=[{'imageDigest': image['imageDigest']} for image in batch]
+        )
+        failures = [failure for failure in response.get('failures', [])
+                    if failure.get('failureCode') != 'ImageNotFound']
+        if failures:
+            raise Exception('Could not delete {0} images in ecr repo {1}: {2}'.format(
+                len(failures), repo_name, failures[0]))
+        deleted.extend(batch)
+    return deleted
 
-def delete_ecr_repos(ecr_repo_names):
-    for repo_name in ecr_repo_names:
-        print('Deleting ecr repo: {}'.format(repo_name))
-        response = ecr_client.delete_repository(
+def delete_ecr_repo(repo_name, has_time):
+    """Deletes a repo. Returns (deleted, images deleted, bytes reclaimed), where deleted is False if out of time."""
+    page = describe_images(repo_name)
+    if page is None:
+        print('ECR repo {0} does not exist'.format(repo_name))
+        return True, 0, 0
+
+    deleted_images = get_images(page)
+    if page.get('nextToken') or len(deleted_images) > DELETE_BATCH_SIZE:
+        print('Deleting the images in ecr repo {0} in batches'.format(repo_name))
+        deleted_images = []
+        while True:
+            images = get_images(page)
+            deleted = delete_images(repo_name, images, has_time)
+            deleted_images.extend(deleted)
+            if len(deleted) < len(images) or (page.get('nextToken') and not has_time()):
+                return False, len(deleted_images), sum(image['size'] for image in deleted_images)
+            if not page.get('nextToken'):
+                break
+            # Deleted images drop out of the listing, so the next images are on the first page again.
+            page = describe_images(repo_name)
+            if page is None:
+                return True, len(deleted_images), sum(image['size'] for image in deleted_images)
+
+    print('Deleting ecr repo: {}'.format(repo_name))
+    try:
+        ecr_client.delete_repository(
             repositoryName=repo_name,
             force=True
         )
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'RepositoryNotFoundException':
+            raise
+    return True, len(deleted_images), sum(image['size'] for image in deleted_images)
+
+def delete_ecr_repos(event, checkpoint, has_time):
+    """Deletes the repos concurrently. Returns the summary, and the checkpoint of the repos left or None if done."""
+    if event['RequestType'] != 'Delete':
+        print('No-Op. This function should only be used on delete stack events.')
+        return {}, None
+
+    if checkpoint is None:
+        checkpoint = {'repos': event['ResourceProperties']['ECRRepoNames'], 'images': 0, 'bytes': 0}
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = list(executor.map(lambda repo_name: delete_ecr_repo(repo_name, has_time), checkpoint['repos']))
+
+    checkpoint = {
+        'repos': [repo_name for repo_name, result in zip(checkpoint['repos'], results) if not result[0]],
+        'images': checkpoint['images'] + sum(result[1] for result in results),
+        'bytes': checkpoint['bytes'] + sum(result[2] for result in results),
+    }
+    print('Deleted {0} images ({1:.1f} MB) so far, {2} ecr repos left'.format(
+        checkpoint['images'], checkpoint['bytes'] / 1024.0 / 1024.0, len(checkpoint['repos'])))
+    response_data = {'ImagesDeleted': checkpoint['images'], 'BytesReclaimed': checkpoint['bytes']}
+    return response_data, checkpoint if checkpoint['repos'] else None
 
 def lambda_handler(event, context):
     print(json.dumps(event, indent=2))
-    response_data = {}
-    reason = 'N/A'
-    try:
-        ecr_repo_names = event['ResourceProperties']['ECRRepoNames']
-
-        if event['RequestType'] == 'Delete':
-            delete_ecr_repos(ecr_repo_names)
-        else:
-            print('No-Op. This function should only be used on delete stack events.')
-
-        return send_response(event, context, 'SUCCESS', response_data, reason)
-    except Exception as e:
-        print(e)
-        # Change 'FAILED' to 'SUCCESS' for debugging in line below for debugging this Lambda function.
-        return send_response(event, context, 'FAILED', response_data, reason)
+    custom_resource.run(event, context, delete_ecr_repos)
@@ -1,85 +1,127 @@
+import os
 import json
 import logging
-import uuid
 import string
 import random
-import requests
+import time
 import boto3
-from requests import Request, Session
+import botocore
+from concurrent.futures import ThreadPoolExecutor
+import custom_resource
 
-# This function force deletes the ENI associated with a Lambda function residing
+# This function force deletes the ENIs associated with a Lambda function residing
 # inside of a VPC. There is currently a bug in CloudFormation not deleting lambda
 # functions created inside of a VPC upon stack deletion.
 # https://forums.aws.amazon.com/thread.jspa?messageID=756642
 # TODO (jason.debolt): Delete this function once AWS figures out how to automatically
 # delete these interfaces.
+#
+# Every ENI in the security group is swept in rounds: attached ENIs are detached concurrently, their states are
+# polled with one describe call per poll until they are available, and available ENIs are deleted in parallel.
+# Rounds are repeated until no ENIs are left or the deadline has passed. The deadline is the time the sweep gets
+# across all the invocations custom_resource.py allows, so the sweep gives up with its own reason before they run out.
 
-ec2_client = boto3.client('ec2')
-
-def send_response(event, context, response_status, response_data, reason):
-    """Send a Success or Failure event back to CFN stack"""
-
-    payload = {
-        'StackId': event['StackId'],
-        'Status' : response_status,
-        'Reason' : reason,
-        'RequestId': event['RequestId'],
-        'LogicalResourceId': event['LogicalResourceId'],
-        'Data': response_data
-    }
+MAX_WORKERS = int(os.environ.get('SWEEP_MAX_WORKERS', '8'))
+POLL_INTERVAL_SECONDS = 3
 
-    payload['PhysicalResourceId'] = event.get(
-        'PhysicalResourceId', str(uuid.uuid4()))
+ec2_client = boto3.client('ec2')
 
-    print("Sending %s to %s" % (json.dumps(payload), event['ResponseURL']))
-    requests.put(event['ResponseURL'], data=json.dumps(payload))
-    print("Sent %s to %s" % (json.dumps(payload), event['ResponseURL']))
+def get_network_interfaces(filters):
+    network_interfaces = []
+    paginator = ec2_client.get_paginator('describe_network_interfaces')
+    for page in paginator.paginate(Filters=filters):
+        network_interfaces.extend(page.get('NetworkInterfaces', []))
+    return network_interfaces
 
+def detach_network_interface(network_interface):
+    """Returns True if the network interface is being detached."""
+    # A NetworkInterfaces must be detached before it can be deleted.
+    network_interface_id = network_interface['NetworkInterfaceId']
+    attachment_id = network_interface['Attachment']['AttachmentId']
+    print('Detaching network interface {0} with attachment id {1}'.format(network_interface_id, attachment_id))
+    try:
+        ec2_client.detach_network_interface(AttachmentId=attachment_id, Force=True)
+    except botocore.exceptions.ClientError as e:
+        # E.g. the attachment is still in use by Lambda. The next round tries again.
+        print('Could not detach network interface {0}: {1}'.format(network_interface_id, e))
+        return False
+    return True
 
-def delete_network_interface(security_group_id):
-    eni = ec2_client.describe_network_interfaces(Filters=[{
-        'Name': 'group-id',
-        'Values': [security_group_id]
-    }])
-    if len(eni.get('NetworkInterfaces', [])) > 0:
-        print(json.dumps(eni, default=str, indent=2))
-        network_interface = eni.get('NetworkInterfaces', [{}])[0]
-        if network_interface:
-            network_interface_id = network_interface.get('NetworkInterfaceId')
-            print('network_interface_id: {0}'.format(network_interface_id))
+def delete_available_network_interface(network_interface_id):
+    """Returns True if the network interface was deleted or is already gone."""
+    print('Deleting network interface {0}'.format(network_interface_id))
+    try:
+        ec2_client.delete_network_interface(NetworkInterfaceId=network_interface_id)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'InvalidNetworkInterfaceID.NotFound':
+            return True
+        print('Could not delete network interface {0}: {1}'.format(network_interface_id, e))
+        return False
+    return True
 
-            # A NetworkInterfaces must be detached before it can be deleted.
-            print('Checking if the networking interface is currently attached')
-            attachment = network_interface.get('Attachment', {})
-            if attachment and 'AttachmentId' in attachment:
-                attachment_id = attachment['AttachmentId']
-                print('network interface has an attachment id {0}'.format(attachment_id))
-                print('attempting to detach network interface')
-                detachment_response = ec2_client.detach_network_interface(
-                    AttachmentId=attachment_id,
-                    Force=True)
-                print(detachment_response)
-            else:
-                print('No attachment or AttachmentId found in network interface. Skipping detachment.')
+def wait_for_available(network_interface_ids, has_time):
+    """Polls the states of the network interfaces in one describe call per poll. Returns the available ids."""
+    while True:
+        network_interfaces = get_network_interfaces([{'Name': 'network-interface-id', 'Values': network_interface_ids}])
+        statuses = {network_interface['NetworkInterfaceId']: network_interface['Status']
+                    for network_interface in network_interfaces}
+        available = [network_interface_id for network_interface_id, status in statuses.items()
+                     if status == 'available']
+        if len(available) == len(statuses) or not has_time():
+            return available
+        print('Waiting for {0} of {1} network interfaces to be detached'.format(
+            len(statuses) - len(available), len(statuses)))
+        time.sleep(POLL_INTERVAL_SECONDS)
 
-            print('attempting to delete network interface')
-            delete_response = ec2_client.delete_network_interface(
-                NetworkInterfaceId=network_interface_id
-            )
-            print(delete_response)
-    else:
+def delete_network_interfaces(security_group_id, has_time):
+    """Runs one sweep round. Returns the number of network interfaces deleted and left."""
+    network_interfaces = get_network_interfaces([{'Name': 'group-id', 'Values': [security_group_id]}])
+    if not network_interfaces:
         print('There are not network interfaces associated with '
               'security group {0}'.format(security_group_id))
+        return 0, 0
+    print('Found {0} network interfaces associated with security group {1}'.format(
+        len(network_interfaces), security_group_id))
 
-def lambda_handler(event, context):
-    print(json.dumps(event, indent=2))
-    response_data = {}
-    security_group_id = event['ResourceProperties']['SecurityGroupId']
-    reason = 'N/A'
+    attached = [network_interface for network_interface in network_interfaces
+                if network_interface.get('Attachment', {}).get('AttachmentId')
+                and network_interface['Attachment'].get('Status') in ('attaching', 'attached')]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        detached = list(executor.map(detach_network_interface, attached))
+        # Network interfaces that could not be detached are left for the next round.
+        not_detached = set(network_interface['NetworkInterfaceId']
+                           for network_interface, is_detached in zip(attached, detached) if not is_detached)
+        network_interface_ids = [network_interface['NetworkInterfaceId'] for network_interface in network_interfaces
+                                 if network_interface['NetworkInterfaceId'] not in not_detached]
+        available = wait_for_available(network_interface_ids, has_time) if network_interface_ids else []
+        deleted = sum(executor.map(delete_available_network_interface, available))
+    return deleted, len(network_interfaces) - deleted
 
-    if event['RequestType'] == 'Delete':
-        delete_network_interface(security_group_id)
-    else:
+def delete_security_group_network_interface(event, checkpoint, has_time, deadline_seconds):
+    if event['RequestType'] != 'Delete':
         print('No-Op. This function should only be used on delete stack events.')
+        return {}, None
+
+    security_group_id = event['ResourceProperties']['SecurityGroupId']
+    if checkpoint is None:
+        checkpoint = {'deadline': time.time() + deadline_seconds, 'deadline_seconds': deadline_seconds, 'deleted': 0}
+    while True:
+        deleted, left = delete_network_interfaces(security_group_id, has_time)
+        checkpoint = dict(checkpoint, deleted=checkpoint['deleted'] + deleted)
+        if not left:
+            print('Deleted {0} network interfaces'.format(checkpoint['deleted']))
+            return {'NetworkInterfacesDeleted': checkpoint['deleted']}, None
+        if time.time() > checkpoint['deadline']:
+            raise Exception('{0} network interfaces of security group {1} still not deleted after {2} seconds'.format(
+                left, security_group_id, int(checkpoint['deadline_seconds'])))
+        if not has_time():
+            return {}, checkpoint
+        print('{0} network interfaces left, retrying in {1} seconds'.format(left, POLL_INTERVAL_SECONDS))
+        time.sleep(POLL_INTERVAL_SECONDS)
 
-    return send_response(event, context, 'SUCCESS', response_data, reason)
+def lambda_handler(event, context):
+    print(json.dumps(event, indent=2))
+    # Only the first invocation sets the deadline, when each invocation gets as much time as this one.
+    deadline_seconds = custom_resource.get_work_seconds(context)
+    custom_resource.run(event, context, lambda event, checkpoint, has_time: delete_security_group_network_interface(
+        event, checkpoint, has_time, deadline_seconds))
@@ -1,57 +1,115 @@
+import os
 import json
 import logging
-import uuid
 import string
 import random
-import requests
+import time
 import boto3
-from requests import Request, Session
+import botocore
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+import custom_resource
 
 # This is a CloudFormation Custom Lambda resource that automatically deletes
 # all files in one or more S3 buckets. This is particularly useful when deleting S3 bucket
 # resources in CloudFormation since CloudFormation cannot delete non-empty S3 buckets.
+#
+# All object versions and delete markers are deleted, so versioned buckets can be deleted as well.
+# Each bucket is split into one task per top level prefix (plus one for the objects at the root), and the
+# tasks run on a thread pool, deleting up to 1,000 versions per DeleteObjects call. When the function is
+# about to time out, it invokes itself asynchronously to continue (see custom_resource.py). Deleted versions
+# don't show up in listings, so the next invocation splits the buckets into tasks again and only carries the
+# totals in its checkpoint, which keeps the checkpoint small whatever the number of prefixes. The last
+# invocation responds to CloudFormation.
 
-s3_resource = boto3.resource('s3')
+MAX_WORKERS = int(os.environ.get('PURGE_MAX_WORKERS', '16'))
+DELETE_BATCH_SIZE = 1000  # The most keys a DeleteObjects call accepts.
 
-def send_response(event, context, response_status, response_data, reason):
-    """Send a Success or Failure event back to CFN stack"""
+s3_client = boto3.client('s3', config=Config(max_pool_connections=MAX_WORKERS))
 
-    payload = {
-        'StackId': event['StackId'],
-        'Status' : response_status,
-        'Reason' : reason,
-        'RequestId': event['RequestId'],
-        'LogicalResourceId': event['LogicalResourceId'],
-        'Data': response_data
-    }
+def get_purge_tasks(bucket_name):
+    """Splits a bucket into one task per top level prefix, plus one for the objects at the root."""
+    tasks = [{'bucket': bucket_name, 'prefix': '', 'delimiter': '/'}]
+    paginator = s3_client.get_paginator('list_object_versions')
+    try:
+        for page in paginator.paginate(Bucket=bucket_name, Delimiter='/'):
+            for common_prefix in page.get('CommonPrefixes', []):
+                tasks.append({'bucket': bucket_name, 'prefix': common_prefix['Prefix']})
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchBucket':
+            print('Bucket {0} does not exist'.format(bucket_name))
+            return []
+        raise
+    print('Deleting files in bucket {0} with {1} tasks'.format(bucket_name, len(tasks)))
+    return tasks
 
-    payload['PhysicalResourceId'] = event.get(
-        'PhysicalResourceId', str(uuid.uuid4()))
+def purge(task, has_time):
+    """Deletes the versions and delete markers of a task, a page at a time.
 
-    print("Sending %s to %s" % (json.dumps(payload), event['ResponseURL']))
-    requests.put(event['ResponseURL'], data=json.dumps(payload))
-    print("Sent %s to %s" % (json.dumps(payload), event['ResponseURL']))
+    Returns the number of objects deleted, and whether the task finished before it ran out of time.
+    """
+    deleted = 0
+    key_marker = version_id_marker = None
+    while has_time():
+        kwargs = {'Bucket': task['bucket'], 'Prefix': task['prefix'], 'MaxKeys': DELETE_BATCH_SIZE}
+        if task.get('delimiter'):
+            kwargs['Delimiter'] = task['delimiter']
+        if key_marker:
+            kwargs['KeyMarker'] = key_marker
+        if version_id_marker:
+            kwargs['VersionIdMarker'] = version_id_marker
+        page = s3_client.list_object_versions(**kwargs)
+        objects = [{'Key': version['Key'], 'VersionId': version['VersionId']}
+                   for version in page.get('Versions', []) + page.get('DeleteMarkers', [])]
+        if objects:
+            response = s3_client.delete_objects(
+                Bucket=task['bucket'], Delete={'Objects': objects, 'Quiet': True})
+            if response.get('Errors'):
+                raise Exception('Could not delete {0} objects in bucket {1}: {2}'.format(
+                    len(response['Errors']), task['bucket'], response['Errors'][0]))
+            deleted += len(objects)
+        if not page.get('IsTruncated'):
+            return deleted, True
+        # A page that ends on a common prefix of the root task has no NextVersionIdMarker.
+        key_marker = page.get('NextKeyMarker')
+        version_id_marker = page.get('NextVersionIdMarker')
+    return deleted, False
 
-def delete_s3_files(bucket_names):
-    for bucket_name in bucket_names:
-        print('Deleting files in bucket: {}'.format(bucket_name))
-        bucket = s3_resource.Bucket(bucket_name)
-        bucket.objects.all().delete()
+def delete_s3_files(event, checkpoint, has_time):
+    """Runs the purge until it's done or the function is about to time out.
 
-def lambda_handler(event, context):
-    print(json.dumps(event, indent=2))
-    response_data = {}
-    reason = 'N/A'
-    try:
+    Returns the response data, and the checkpoint of the totals so far or None if the buckets are empty.
+    """
+    if event['RequestType'] != 'Delete':
+        print('No-Op. This function should only be used on delete stack events.')
+        return {}, None
+
+    checkpoint = checkpoint or {'deleted': 0, 'seconds': 0}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
         bucket_names = event['ResourceProperties']['BucketNames']
+        tasks = [task for tasks in executor.map(get_purge_tasks, bucket_names) for task in tasks]
 
-        if event['RequestType'] == 'Delete':
-            delete_s3_files(bucket_names)
-        else:
-            print('No-Op. This function should only be used on delete stack events.')
+        start = time.time()
+        results = list(executor.map(lambda task: purge(task, has_time), tasks))
 
-        return send_response(event, context, 'SUCCESS', response_data, reason)
-    except Exception as e:
-        print(e)
-        # Change 'FAILED' to 'SUCCESS' for debugging in line below for debugging this Lambda function.
-        return send_response(event, context, 'FAILED', response_data, reason)
+    deleted = sum(result[0] for result in results)
+    seconds = time.time() - start
+    tasks_left = len([result for result in results if not result[1]])
+    checkpoint = {
+        'deleted': checkpoint['deleted'] + deleted,
+        'seconds': checkpoint['seconds'] + seconds,
+    }
+    print('Deleted {0} objects in {1:.1f}s ({2:.0f} objects/s), {3} objects in {4:.1f}s in total ({5:.0f} objects/s), '
+          '{6} tasks left'.format(
+              deleted, seconds, deleted / max(seconds, 0.001),
+              checkpoint['deleted'], checkpoint['seconds'], checkpoint['deleted'] / max(checkpoint['seconds'], 0.001),
+              tasks_left))
+    response_data = {
+        'ObjectsDeleted': checkpoint['deleted'],
+        'ObjectsPerSecond': int(checkpoint['deleted'] / max(checkpoint['seconds'], 0.001)),
+    }
+    return response_data, checkpoint if tasks_left else None
+
+def lambda_handler(event, context):
+    print(json.dumps(event, indent=2))
+    custom_resource.run(event, context, delete_s3_files)
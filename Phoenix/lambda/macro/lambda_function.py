@@ -4,16 +4,54 @@ import string
 import os
 import boto3
 import botocore
-import tempfile
+from botocore.exceptions import ClientError
 import copy
+import collections
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 __author__ = "Jason DeBolt (jasondebolt@gmail.com)"
 
 ssm_client = boto3.client('ssm')
-s3_resource = boto3.resource('s3')
+s3_client = boto3.client('s3')
 
 PROJECT_NAME = os.environ['PHX_MACRO_PROJECT_NAME']
 
+# 'INFO' logs a single line summary per invocation. 'DEBUG' also logs the event,
+# the fetched parameters and the resolved fragment, with SecureString values masked.
+LOG_LEVEL = os.environ.get('PHX_MACRO_LOG_LEVEL', 'INFO').upper()
+DEBUG = LOG_LEVEL == 'DEBUG'
+
+# PhoenixSSM values that can't be resolved are left in place and reported in the
+# macro response. Set to 'true' to fail the transform instead.
+FAIL_ON_UNRESOLVED = os.environ.get('PHX_MACRO_FAIL_ON_UNRESOLVED', 'false').lower() == 'true'
+
+# SSM parameters are cached at the module level so they survive across warm
+# invocations of this Lambda container. Once an entry's TTL expires it is
+# fetched again with GetParameters, and counted as invalidated if its
+# Version/LastModifiedDate changed. Names that do not exist in parameter store
+# are not cached, so a parameter created after a failed deploy is found on the next one.
+SSM_CACHE_TTL_SECONDS = int(os.environ.get('PHX_MACRO_SSM_CACHE_TTL_SECONDS', '300'))
+
+# GetParameters accepts at most 10 names per call.
+SSM_BATCH_SIZE = 10
+SSM_MAX_WORKERS = 4
+
+_ssm_cache = {}  # Parameter name --> {'param': SSM parameter object, 'expires_at': ...}
+_ssm_cache_stats = {'invocations': 0, 'hits': 0, 'misses': 0, 'invalidations': 0}
+
+# PhoenixS3Transform includes are cached by bucket/key/ETag, in memory and under
+# /tmp, both of which survive across warm invocations. Every invocation still
+# revalidates each distinct include once with a conditional GET (IfNoneMatch).
+S3_INCLUDE_CACHE_DIR = '/tmp/phx-macro-s3-includes'
+S3_INCLUDE_MEMORY_ENTRIES = 32
+S3_INCLUDE_DISK_ENTRIES = 256
+
+_s3_include_etags = {}  # (bucket, key) --> ETag of the last fetched version
+_s3_include_memory = collections.OrderedDict()  # (bucket, key, ETag) --> parsed JSON, in LRU order
+_s3_include_stats = {'fetches': 0, 'not_modified': 0, 'memory_hits': 0, 'disk_hits': 0}
+
 def safe_print_parameters(list_of_ssm_params):
     ssm_list = copy.deepcopy(list_of_ssm_params)
     for param in ssm_list:
@@ -21,8 +59,9 @@ def safe_print_parameters(list_of_ssm_params):
             param['Value'] = '*'*len(param['Value'])
     print(json.dumps(ssm_list, indent=2, default=str))
 
-def get_ssm_params_by_path(path):
-    """ Returns a list of SSM parameter object.
+def get_ssm_params_batch(names):
+    """ Returns a list of SSM parameter objects for up to 10 names, and a dict of
+    name --> reason for the names parameter store rejected as invalid.
     [
         {
           "Name": "...",
@@ -35,77 +74,276 @@ def get_ssm_params_by_path(path):
         ...
     ]
     """
+    try:
+        response = ssm_client.get_parameters(
+            Names=names,
+            WithDecryption=True
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ValidationException':
+            raise
+        # One malformed name (e.g. too long or with illegal characters after formatting)
+        # fails the whole batch, so look the names up one at a time to find it.
+        if len(names) == 1:
+            print('Invalid SSM parameter name {0}: {1}'.format(names[0], e))
+            return [], {names[0]: 'Invalid SSM parameter name: {0}'.format(e.response['Error']['Message'])}
+        params, invalid = [], {}
+        for name in names:
+            name_params, name_invalid = get_ssm_params_batch([name])
+            params.extend(name_params)
+            invalid.update(name_invalid)
+        return params, invalid
+    return response['Parameters'], {}
+
+def get_ssm_params_by_name(names):
+    """ Fetches SSM parameters with concurrent, batched GetParameters calls.
+    Returns the parameters found, and a dict of name --> reason for the invalid names."""
+    batches = [names[index:index + SSM_BATCH_SIZE]
+               for index in range(0, len(names), SSM_BATCH_SIZE)]
+    if not batches:
+        return [], {}
     result = []
-    next_token = ''
-    while True:
-        args = {
-            'Path': path,
-            'Recursive': True,
-            'WithDecryption': True,
-            'MaxResults': 10,
-        }
-        if next_token:
-            args['NextToken'] = next_token
-        response = ssm_client.get_parameters_by_path(**args)
-        result.extend(response['Parameters'])
-        if not response.get('NextToken'):
-            break
-        next_token = response['NextToken']
-    safe_print_parameters(result)
-    return result
+    invalid = {}
+    with ThreadPoolExecutor(max_workers=min(SSM_MAX_WORKERS, len(batches))) as executor:
+        for params, batch_invalid in executor.map(get_ssm_params_batch, batches):
+            result.extend(params)
+            invalid.update(batch_invalid)
+    if DEBUG:
+        safe_print_parameters(result)
+    return result, invalid
+
+def _param_fingerprint(param):
+    if param is None:
+        return None
+    return (param['Version'], str(param['LastModifiedDate']))
+
+def get_cached_ssm_params(names):
+    """ Returns a dict of name --> SSM parameter object for the names found in
+    parameter store, using the warm container cache when possible, and a dict of
+    name --> reason for the invalid names."""
+    now = time.time()
+    result = {}
+    stale_names = []
+    for name in names:
+        entry = _ssm_cache.get(name)
+        if entry and now < entry['expires_at']:
+            _ssm_cache_stats['hits'] += 1
+            result[name] = entry['param']
+        else:
+            stale_names.append(name)
 
-def get_ssm_map():
+    params, invalid = get_ssm_params_by_name(stale_names)
+    fetched = {param['Name']: param for param in params}
+    expires_at = time.time() + SSM_CACHE_TTL_SECONDS
+    for name in stale_names:
+        _ssm_cache_stats['misses'] += 1
+        param = fetched.get(name)
+        entry = _ssm_cache.get(name)
+        if entry and _param_fingerprint(entry['param']) != _param_fingerprint(param):
+            _ssm_cache_stats['invalidations'] += 1
+        if param is None:
+            _ssm_cache.pop(name, None)
+        else:
+            _ssm_cache[name] = {'param': param, 'expires_at': expires_at}
+            result[name] = param
+    return result, invalid
+
+def get_ssm_map(names):
     replace_map = {}
     safe_replace_map = {}
-    ssm_path = '/microservice/{0}/'.format(PROJECT_NAME)
-    ssm_params = get_ssm_params_by_path(ssm_path)
-    for param in ssm_params:
+    secret_values = set()
+    ssm_params, invalid = get_cached_ssm_params(names)
+    for param in ssm_params.values():
         param_key, param_value = param['Name'], param['Value']
         # '/microservice/{project_name}/global/some-param-key' --> 'PHX_MACRO_SOME_PARAM_KEY'
         replace_map[param_key] = param_value
         # Hide the value if this is an encrypted value
         safe_replace_map[param_key] = param_value if param['Type'] != 'SecureString' else '*'*len(param['Value'])
-    return replace_map, safe_replace_map
-
-def macro_phoenix_ssm_replace(obj, replace_map, params_map):
-    # Replaces dicts of {"PhoenixSSM": /microservice/{ProjectName}/../{Environment}/...}  with SSM values.
-    if isinstance(obj, dict):
-        for key in obj:
-            if isinstance(obj[key], dict):
-              if "PhoenixSSM" in obj[key]:
-                  PhoenixVal = obj[key]["PhoenixSSM"].format(**params_map)
-                  replace_val = replace_map.get(PhoenixVal)
-                  if replace_val is not None:
-                      obj[key] = replace_val
-        for key, value in obj.items():
-            macro_phoenix_ssm_replace(value, replace_map, params_map)
-    elif isinstance(obj, list):
-        for index, item in enumerate(obj):
-            if isinstance(item, dict):
-                if "PhoenixSSM" in item:
-                    PhoenixVal = item["PhoenixSSM"].format(**params_map)
-                    replace_val = replace_map.get(PhoenixVal)
-                    if replace_val is not None:
-                        obj[index] = replace_val
-            macro_phoenix_ssm_replace(item, replace_map, params_map)
+        if param['Type'] == 'SecureString':
+            secret_values.add(param_value)
+    return replace_map, safe_replace_map, secret_values, invalid
+
+def mask_secret_values(text, secret_values):
+    # Masks secret values within serialized JSON text.
+    for secret_value in secret_values:
+        escaped_value = json.dumps(secret_value)[1:-1]
+        if escaped_value:
+            text = text.replace(escaped_value, '*'*len(escaped_value))
+    return text
+
+def json_size(obj):
+    return len(json.dumps(obj, separators=(',', ':'), default=str))
 
 def get_ssm_project_bucket_name():
     ssm_path = '/microservice/{0}/global/bucket-name'.format(PROJECT_NAME)
-    response = ssm_client.get_parameter(
-        Name=ssm_path,
-        WithDecryption=False
-    )
-    return response['Parameter']['Value']
+    # Served from the warm container cache when possible.
+    return get_cached_ssm_params([ssm_path])[0][ssm_path]['Value']
+
+def _s3_include_cache_path(bucketname, filename, etag):
+    digest = hashlib.sha256('{0}/{1}/{2}'.format(bucketname, filename, etag).encode()).hexdigest()
+    return os.path.join(S3_INCLUDE_CACHE_DIR, digest + '.json')
+
+def _remember_s3_include(cache_key, result):
+    _s3_include_memory[cache_key] = result
+    _s3_include_memory.move_to_end(cache_key)
+    while len(_s3_include_memory) > S3_INCLUDE_MEMORY_ENTRIES:
+        _s3_include_memory.popitem(last=False)
+
+def _save_s3_include(cache_key, body):
+    try:
+        os.makedirs(S3_INCLUDE_CACHE_DIR, exist_ok=True)
+        with open(_s3_include_cache_path(*cache_key), 'wb') as cache_file:
+            cache_file.write(body)
+        cache_files = [os.path.join(S3_INCLUDE_CACHE_DIR, name)
+                       for name in os.listdir(S3_INCLUDE_CACHE_DIR)]
+        if len(cache_files) > S3_INCLUDE_DISK_ENTRIES:
+            # Evict the least recently used files.
+            cache_files.sort(key=os.path.getmtime)
+            for path in cache_files[:len(cache_files) - S3_INCLUDE_DISK_ENTRIES]:
+                os.remove(path)
+    except OSError as e:
+        print('Unable to cache S3 include on disk: {0}'.format(e))
+
+def _load_s3_include(cache_key):
+    if cache_key in _s3_include_memory:
+        _s3_include_stats['memory_hits'] += 1
+        _s3_include_memory.move_to_end(cache_key)
+        return _s3_include_memory[cache_key]
+    path = _s3_include_cache_path(*cache_key)
+    try:
+        with open(path, 'rb') as cache_file:
+            result = json.loads(cache_file.read().decode('utf-8'))
+        os.utime(path, None)  # Mark as recently used.
+    except (OSError, ValueError):
+        return None
+    _s3_include_stats['disk_hits'] += 1
+    _remember_s3_include(cache_key, result)
+    return result
 
 def get_obj_from_s3_file(bucketname, filename):
-  tmp_file = tempfile.NamedTemporaryFile()
-  s3_resource.meta.client.download_file(bucketname, filename, tmp_file.name)
-  rfile = open(tmp_file.name, 'r')
-  result = json.loads(rfile.read())
-  rfile.close()
-  return result
-
-def macro_phoenix_s3_transform(obj, params_map, project_bucket_name):
+    """Returns the parsed JSON of an S3 file.
+
+    The returned object is shared with the cache and must not be mutated.
+    """
+    etag = _s3_include_etags.get((bucketname, filename))
+    args = {'Bucket': bucketname, 'Key': filename}
+    if etag:
+        args['IfNoneMatch'] = etag
+    try:
+        response = s3_client.get_object(**args)
+    except ClientError as e:
+        if not etag or e.response['Error']['Code'] not in ('304', 'NotModified'):
+            raise
+        _s3_include_stats['not_modified'] += 1
+        result = _load_s3_include((bucketname, filename, etag))
+        if result is not None:
+            return result
+        # Evicted from both caches, fetch the file unconditionally.
+        del _s3_include_etags[(bucketname, filename)]
+        return get_obj_from_s3_file(bucketname, filename)
+
+    _s3_include_stats['fetches'] += 1
+    body = response['Body'].read()
+    result = json.loads(body.decode('utf-8'))
+    cache_key = (bucketname, filename, response['ETag'])
+    _s3_include_etags[(bucketname, filename)] = response['ETag']
+    _remember_s3_include(cache_key, result)
+    _save_s3_include(cache_key, body)
+    return result
+
+# Template transforms are registered by the key marking the dicts they replace,
+# e.g. {"PhoenixSSM": ...} or {"PhoenixS3Transform": ...}. A transform is called
+# as transform(node, context, container, key) and returns the replacement value.
+TEMPLATE_TRANSFORMS = collections.OrderedDict()
+
+def template_transform(marker):
+    """Registers a function as the template transform for dicts containing marker."""
+    def register(func):
+        TEMPLATE_TRANSFORMS[marker] = func
+        return func
+    return register
+
+def walk_template(fragment, context, transforms=None):
+    """Applies all registered transforms to the fragment in a single traversal.
+
+    The traversal uses an explicit stack instead of recursion, so deeply nested
+    templates can't hit the recursion limit. Values returned by a transform are
+    walked as well, which expands transforms nested inside of S3 includes.
+    """
+    if transforms is None:
+        transforms = TEMPLATE_TRANSFORMS
+    stack = [fragment]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, dict):
+            items = obj.items()
+        elif isinstance(obj, list):
+            items = enumerate(obj)
+        else:
+            continue
+        for key, value in items:
+            if isinstance(value, dict):
+                for marker, transform in transforms.items():
+                    if marker in value:
+                        value = transform(value, context, obj, key)
+                        # Replacing an existing key does not resize the dict being iterated.
+                        obj[key] = value
+                        break
+            if isinstance(value, (dict, list)):
+                stack.append(value)
+
+def new_transform_context(params_map):
+    return {
+        'params_map': params_map,
+        'ssm_slots': [],  # (container, key, formatted PhoenixSSM path)
+        'ssm_formatted': {},  # Raw PhoenixSSM value --> formatted path, or None if it can't be formatted
+        'ssm_unresolved': {},  # PhoenixSSM path --> reason it was left in place
+        's3_includes': {},  # S3 key --> parsed JSON, so repeated includes are fetched once
+        'project_bucket_name': None,
+    }
+
+@template_transform('PhoenixSSM')
+def transform_phoenix_ssm(node, context, container, key):
+    """Defers the replacement of {"PhoenixSSM": "/microservice/{ProjectName}/../{Environment}/..."}
+    values until the walk is done, so all referenced parameters can be fetched together.
+    See apply_phoenix_ssm_values().
+    """
+    raw_path = node['PhoenixSSM']
+    formatted = context['ssm_formatted']
+    # The same templated paths repeat throughout a template, so only format each once.
+    if raw_path in formatted:
+        path = formatted[raw_path]
+    else:
+        try:
+            path = raw_path.format(**context['params_map'])
+        except KeyError as e:
+            path = None
+            context['ssm_unresolved'][raw_path] = 'Unknown template parameter {0}'.format(e)
+        except (IndexError, ValueError) as e:
+            path = None
+            context['ssm_unresolved'][raw_path] = 'Invalid path: {0}'.format(e)
+        formatted[raw_path] = path
+    if path is not None:
+        context['ssm_slots'].append((container, key, path))
+    return node
+
+def apply_phoenix_ssm_values(context, replace_map, invalid=None):
+    # Replaces the PhoenixSSM dicts collected during the walk with SSM values.
+    # invalid maps the paths parameter store rejected as invalid names to the reason.
+    invalid = invalid or {}
+    for container, key, path in context['ssm_slots']:
+        replace_val = replace_map.get(path)
+        if replace_val is not None:
+            container[key] = replace_val
+        else:
+            context['ssm_unresolved'][path] = invalid.get(path, 'Not found in SSM parameter store')
+
+def get_unresolved_report(context):
+    return [{'path': path, 'reason': reason}
+            for path, reason in sorted(context['ssm_unresolved'].items())]
+
+@template_transform('PhoenixS3Transform')
+def transform_phoenix_s3(node, context, container, key):
     """Replaces references like the following:
 
     {"PhoenixS3Transform": "transform-filename.json"}
@@ -118,49 +356,80 @@ def macro_phoenix_s3_transform(obj, params_map, project_bucket_name):
 
     This is similar to the CloudFormation Transform AWS::Include macro, but less limiting.
     """
-    if isinstance(obj, dict):
-        for key in obj:
-            if isinstance(obj[key], dict):
-              if "PhoenixS3Transform" in obj[key]:
-                  filename = obj[key]["PhoenixS3Transform"]
-                  if isinstance(filename, dict) and "Ref" in filename:
-                      # This could be a {"Ref": "filename.json"} reference.
-                      filename = params_map[filename["Ref"]]
-                  print('filename: ' + filename)
-                  obj[key] = get_obj_from_s3_file(s3_bucket, 'cloudformation/{0}'.format(filename))
-        for key, value in obj.items():
-            macro_phoenix_s3_transform(value, params_map, project_bucket_name)
-    elif isinstance(obj, list):
-        for index, item in enumerate(obj):
-            if isinstance(item, dict):
-                if "PhoenixS3Transform" in item:
-                    filename = item["PhoenixS3Transform"]
-                    if isinstance(filename, dict) and "Ref" in filename:
-                        # This could be a {"Ref": "filename.json"} reference.
-                        filename = params_map[filename["Ref"]]
-                    print('filename: ' + filename)
-                    obj[index] = get_obj_from_s3_file(s3_bucket, 'cloudformation/{0}'.format(filename))
-            macro_phoenix_s3_transform(item, params_map, project_bucket_name)
+    filename = node['PhoenixS3Transform']
+    if isinstance(filename, dict) and "Ref" in filename:
+        # This could be a {"Ref": "filename.json"} reference.
+        filename = context['params_map'][filename["Ref"]]
+    if DEBUG:
+        print('filename: ' + filename)
+    s3_key = 'cloudformation/{0}'.format(filename)
+    includes = context['s3_includes']
+    if s3_key not in includes:
+        if context['project_bucket_name'] is None:
+            context['project_bucket_name'] = get_ssm_project_bucket_name()
+        includes[s3_key] = get_obj_from_s3_file(context['project_bucket_name'], s3_key)
+    # Every occurrence gets its own copy since the walk may modify it.
+    return copy.deepcopy(includes[s3_key])
 
 def lambda_handler(event, context):
-    print(event)
-    print(os.environ)
-    print(json.dumps(event, indent=2, default=str))
+    start_time = time.time()
+    if DEBUG:
+        print(json.dumps(event, indent=2, default=str))
 
     fragment = event['fragment']
-    replace_map, safe_replace_map = get_ssm_map()
     params_map = event['templateParameterValues']
     params_map.update({'ProjectName': PROJECT_NAME}) # Add the ProjectName to the params map
-    print('REPLACE_MAP:', json.dumps(safe_replace_map, indent=2, default=str))
+    bytes_in = json_size(fragment)
 
-    project_bucket_name = get_ssm_project_bucket_name()
+    # A single walk applies every registered transform and collects the
+    # PhoenixSSM paths, so only the parameters this fragment references are fetched.
+    _ssm_cache_stats['invocations'] += 1
+    transform_context = new_transform_context(params_map)
+    walk_template(fragment, transform_context)
+    walk_time = time.time()
 
-    macro_phoenix_ssm_replace(fragment, replace_map, params_map)
-    macro_phoenix_s3_transform(fragment, params_map, project_bucket_name)
-    print(json.dumps(fragment, indent=2, default=str))
+    ssm_paths = sorted(set(path for _, _, path in transform_context['ssm_slots']))
+    replace_map, safe_replace_map, secret_values, invalid_paths = get_ssm_map(ssm_paths)
+    if DEBUG:
+        print('REPLACE_MAP:', json.dumps(safe_replace_map, indent=2, default=str))
 
-    return {
+    apply_phoenix_ssm_values(transform_context, replace_map, invalid_paths)
+    unresolved = get_unresolved_report(transform_context)
+    end_time = time.time()
+
+    summary = {
+        'requestId': event['requestId'],
+        'ssm_refs': len(transform_context['ssm_slots']),
+        'ssm_keys_resolved': len(replace_map),
+        'ssm_unresolved': unresolved,
+        's3_includes': sorted(transform_context['s3_includes']),
+        'bytes_in': bytes_in,
+        'bytes_out': json_size(fragment),
+        'timings_ms': {
+            'walk': int((walk_time - start_time) * 1000),
+            'ssm': int((end_time - walk_time) * 1000),
+            'total': int((end_time - start_time) * 1000),
+        },
+        'ssm_cache': _ssm_cache_stats,
+        's3_include_cache': _s3_include_stats,
+    }
+    print('MACRO_SUMMARY:', json.dumps(summary))
+    if DEBUG:
+        print(mask_secret_values(json.dumps(fragment, indent=2, default=str), secret_values))
+
+    if unresolved and FAIL_ON_UNRESOLVED:
+        return {
+            "requestId": event['requestId'],
+            "status": "failure",
+            "errorMessage": 'Unresolved PhoenixSSM values: {0}'.format(
+                '; '.join('{path} ({reason})'.format(**item) for item in unresolved))
+        }
+
+    response = {
         "requestId": event['requestId'],
         "status": "success",
         "fragment": fragment
     }
+    if unresolved:
+        response['unresolvedPhoenixSSM'] = unresolved
+    return response
@@ -8,13 +8,10 @@ https://docs.google.com/document/d/16UUY3h-4wU372XF8D0Fs1IQ3ABLrO-Vjn5ao2YkB84M/
 """
 import json
 import logging
-import uuid
 import string
 import random
-import requests
 import boto3
-import copy
-from requests import Request, Session
+from cfn_response import send_response
 
 ssm_client = boto3.client('ssm')
 secretsmanager_client = boto3.client('secretsmanager')
@@ -48,31 +45,6 @@ def get_random_password(password_length=20):
         password = ''.join(random.sample(char_set * 6, int(password_length)))
     return password
 
-def send_response(event, context, response_status, response_data, reason):
-    """Send a Success or Failure event back to CFN stack"""
-
-    payload = {
-        'StackId': event['StackId'],
-        'Status' : response_status,
-        'Reason' : reason,
-        'RequestId': event['RequestId'],
-        'LogicalResourceId': event['LogicalResourceId'],
-        'Data': response_data
-    }
-
-    payload['PhysicalResourceId'] = event.get(
-        'PhysicalResourceId', str(uuid.uuid4()))
-
-    safe_payload = copy.deepcopy(payload)
-    if 'Password' in safe_payload['Data']:
-        del safe_payload['Data']['Password'] # Don't display password in logs
-
-    print("Sending %s to %s" % (json.dumps(safe_payload), event['ResponseURL']))
-    requests.put(event['ResponseURL'], data=json.dumps(payload))
-
-    print("Sent %s to %s" % (json.dumps(safe_payload), event['ResponseURL']))
-
-
 def lambda_handler(event, context):
     print(json.dumps(event, indent=2))
     response_data = {}
@@ -108,4 +80,4 @@ def lambda_handler(event, context):
     elif event['RequestType'] == 'Delete':
         print('Delete stack operation, Lambda NoOp.')
 
-    return send_response(event, context, 'SUCCESS', response_data, reason)
+    return send_response(event, context, 'SUCCESS', response_data, reason, log_hidden_keys=['Password'])
@@ -2,20 +2,18 @@ import os
 import json
 import boto3
 import botocore
-import requests
 from datetime import datetime
 import zipfile
 import tempfile
 import urllib.parse
 from boto3.session import Session
+from github_client import GitHubClient
 
 # Handles the final stages of the pull request pipeline, after all tests pass and the ECS container is deployed.
 
 ssm_client = boto3.client('ssm')
 code_pipeline_client = boto3.client('codepipeline')
 
-GITHUB_API_URL = 'https://api.github.com'
-
 class JSONObject:
   def __init__(self, dict):
       vars(self).update(dict)
@@ -47,12 +45,13 @@ def get_microservice_domain():
     )
     return response['Parameter']['Value']
 
+github = GitHubClient(get_github_access_token)
+
 def notify_github(pull_request_number, request_body):
-    url = os.path.join(GITHUB_API_URL, 'repos/{0}/{1}/issues/{2}/comments'.format(
-        os.environ['GITHUB_ORGANIZATION'], os.environ['PROJECT_NAME'], pull_request_number))
+    url = 'repos/{0}/{1}/issues/{2}/comments'.format(
+        os.environ['GITHUB_ORGANIZATION'], os.environ['PROJECT_NAME'], pull_request_number)
     payload = { "body": request_body }
-    headers = {'Authorization': 'token {0}'.format(get_github_access_token())}
-    response = requests.post(url, data=json.dumps(payload), headers=headers)
+    response = github.post(url, payload)
     print(json.dumps(response.json(), indent=2))
 
 def find_artifact(artifacts, name):
@@ -0,0 +1,100 @@
+""" Stores used by the pull request webhook to drop duplicate deliveries and coalesce bursts of events.
+
+A store supports two operations:
+  add_if_absent(key, ttl_seconds): Records the key and returns True, or returns False if it was already recorded.
+  remove(key): Forgets a recorded key, e.g. when the event it was recorded for could not be handled.
+  set_latest(name, value, ttl_seconds) / get_latest(name): Tracks the latest value for a name, e.g. the delivery ID
+    of the latest event for a pull request stack.
+
+get_store() returns a DynamoDBStore when the DEDUP_TABLE_NAME environment variable is set, otherwise a MemoryStore.
+The MemoryStore only sees the events of its own (warm) Lambda container, so it is meant for local runs and tests.
+"""
+
+import os
+import time
+import boto3
+import botocore
+
+
+class MemoryStore(object):
+
+    def __init__(self):
+        self.items = {}
+
+    def _get(self, key):
+        item = self.items.get(key)
+        if item and item['expires_at'] > time.time():
+            return item
+        return None
+
+    def add_if_absent(self, key, ttl_seconds):
+        if self._get(key):
+            return False
+        self.items[key] = {'value': None, 'expires_at': time.time() + ttl_seconds}
+        return True
+
+    def remove(self, key):
+        self.items.pop(key, None)
+
+    def set_latest(self, name, value, ttl_seconds):
+        self.items['latest:' + name] = {'value': value, 'expires_at': time.time() + ttl_seconds}
+
+    def get_latest(self, name):
+        item = self._get('latest:' + name)
+        return item['value'] if item else None
+
+
+class DynamoDBStore(object):
+    """Uses a DynamoDB table with an 'id' string hash key and TTL enabled on 'expires_at'.
+
+    DynamoDB deletes expired items lazily, so expiry is also checked on every read.
+    """
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.dynamodb_client = boto3.client('dynamodb')
+
+    def add_if_absent(self, key, ttl_seconds):
+        now = int(time.time())
+        try:
+            self.dynamodb_client.put_item(
+                TableName=self.table_name,
+                Item={'id': {'S': key}, 'expires_at': {'N': str(now + ttl_seconds)}},
+                ConditionExpression='attribute_not_exists(id) OR expires_at < :now',
+                ExpressionAttributeValues={':now': {'N': str(now)}}
+            )
+            return True
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+
+    def remove(self, key):
+        self.dynamodb_client.delete_item(TableName=self.table_name, Key={'id': {'S': key}})
+
+    def set_latest(self, name, value, ttl_seconds):
+        self.dynamodb_client.put_item(
+            TableName=self.table_name,
+            Item={
+                'id': {'S': 'latest:' + name},
+                'value': {'S': value},
+                'expires_at': {'N': str(int(time.time()) + ttl_seconds)}
+            }
+        )
+
+    def get_latest(self, name):
+        response = self.dynamodb_client.get_item(
+            TableName=self.table_name,
+            Key={'id': {'S': 'latest:' + name}},
+            ConsistentRead=True
+        )
+        item = response.get('Item')
+        if not item or int(item['expires_at']['N']) < time.time():
+            return None
+        return item['value']['S']
+
+
+def get_store():
+    if os.environ.get('DEDUP_TABLE_NAME'):
+        return DynamoDBStore(os.environ['DEDUP_TABLE_NAME'])
+    return MemoryStore()
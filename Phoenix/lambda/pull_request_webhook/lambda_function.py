@@ -2,11 +2,15 @@ import os
 import json
 import boto3
 import botocore
-import requests
 from datetime import datetime
 import urllib.parse
-import hmac
-import base64
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from dedup_store import get_store
+from github_client import GitHubClient
+from github_webhook import (SSMConfig, FINGERPRINT_TAG_KEY, get_raw_body, is_valid_signature, describe_stack,
+                            get_template_etag, get_stack_fingerprint, get_fingerprint_tag)
 
 # Handles GitHub pull request events
 
@@ -14,65 +18,74 @@ import base64
 # https://developer.github.com/v3/activity/events/types/#pullrequestevent
 
 cloudformation_client = boto3.client('cloudformation')
-ssm_client = boto3.client('ssm')
+sqs_client = boto3.client('sqs')
 
-GITHUB_API_URL = 'https://api.github.com'
+# Delivery IDs are remembered for DEDUP_TTL_SECONDS, and queued jobs wait COALESCE_WINDOW_SECONDS
+# so that a later event for the same pull request can supersede them (see dedup_store.py).
+DEDUP_TTL_SECONDS = int(os.environ.get('DEDUP_TTL_SECONDS', '86400'))
+COALESCE_WINDOW_SECONDS = int(os.environ.get('COALESCE_WINDOW_SECONDS', '15'))
+dedup_store = get_store()
 
-class JSONObject:
-  def __init__(self, dict):
-      vars(self).update(dict)
+# Secrets and config are cached for the life of a warm container (see github_webhook.py).
+config = SSMConfig({
+    '/microservice/{0}/global/github/access-token'.format(os.environ['PROJECT_NAME']): 'access_token',
+    '/microservice/{0}/global/github/pull-request-secret'.format(os.environ['PROJECT_NAME']): 'pull_request_secret',
+    '/microservice/{0}/global/bucket-name'.format(os.environ['PROJECT_NAME']): 'bucket_name',
+})
 
-# Assign python values to values return from gitlab JSON reqeuest object
-false = False
-true = True
-null = None
+def get_config(refresh=False):
+    return config.get(refresh)
 
-def get_github_access_token():
-    print('getting github access token')
-    response = ssm_client.get_parameter(
-        Name='/microservice/{0}/global/github/access-token'.format(os.environ['PROJECT_NAME']),
-        WithDecryption=True
-    )
-    return response['Parameter']['Value']
+def get_github_access_token(refresh=False):
+    return get_config(refresh)['access_token']
 
-def get_github_pull_request_secret():
-    print('getting github pull request secret')
-    response = ssm_client.get_parameter(
-        Name='/microservice/{0}/global/github/pull-request-secret'.format(os.environ['PROJECT_NAME']),
-        WithDecryption=True
-    )
-    return response['Parameter']['Value']
+def get_github_pull_request_secret(refresh=False):
+    return get_config(refresh)['pull_request_secret']
 
 def get_microservice_bucket_name():
-    response = ssm_client.get_parameter(
-        Name='/microservice/{0}/global/bucket-name'.format(os.environ['PROJECT_NAME']),
-        WithDecryption=False
-    )
-    return response['Parameter']['Value']
+    return get_config()['bucket_name']
+
+def parse_pull_request_event(raw_body):
+    """Returns only the fields of a pull request event that the handler uses."""
+    payload = json.loads(raw_body.decode('utf-8'))
+    if 'pull_request' not in payload:
+        raise Exception('Object is not a pull request!')
+    pull_request = payload['pull_request']
+    return {
+        'repo_name': pull_request['head']['repo']['name'], # reponame
+        'source_branch': pull_request['head']['ref'], # The pull request branch name
+        'pull_request_number': str(pull_request['number']), # Unique ID for the pull request within this repo.
+        'state': pull_request['state']
+    }
+
+# A 401 refreshes the cached access token from SSM, in case it was rotated.
+github = GitHubClient(get_github_access_token, lambda: get_github_access_token(refresh=True))
 
 def notify_github(pull_request_number, request_body):
-    url = os.path.join(GITHUB_API_URL, 'repos/{0}/{1}/issues/{2}/comments'.format(
-        os.environ['GITHUB_ORGANIZATION'], os.environ['PROJECT_NAME'], pull_request_number))
+    url = 'repos/{0}/{1}/issues/{2}/comments'.format(
+        os.environ['GITHUB_ORGANIZATION'], os.environ['PROJECT_NAME'], pull_request_number)
     payload = { "body": request_body }
-    headers = {'Authorization': 'token {0}'.format(get_github_access_token())}
-    response = requests.post(url, data=json.dumps(payload), headers=headers)
+    response = github.post(url, payload)
     print(json.dumps(response.json(), indent=2))
 
 def create_or_update_stack(
-    create, stack_name, template_url, parameters, pull_request_number):
+    create, stack_name, template_url, parameters, pull_request_number, fingerprint):
+    tags = [{'Key': FINGERPRINT_TAG_KEY, 'Value': fingerprint}]
     if create:
         response = cloudformation_client.create_stack(
           StackName=stack_name,
           TemplateURL=template_url,
           Parameters=parameters,
-          Capabilities=['CAPABILITY_IAM']
+          Capabilities=['CAPABILITY_IAM'],
+          Tags=tags
         )
     else:
         response = cloudformation_client.update_stack(
           StackName=stack_name,
           TemplateURL=template_url,
           Parameters=parameters,
-          Capabilities=['CAPABILITY_IAM']
+          Capabilities=['CAPABILITY_IAM'],
+          Tags=tags
         )
     # Notify gitlab
     region = os.environ['AWS_DEFAULT_REGION']
@@ -87,19 +100,149 @@ def create_or_update_stack(
             emoji=MONTH_EMOJI_MAP.get(datetime.now().month, ':white_check_mark:'))
     notify_github(pull_request_number, request_body)
 
+# The stacks of a pull request environment by name suffix, each mapped to the stacks that must be fully
+# deleted before it and listed above it. The ECS main deploy stack imports outputs of the EC2 and Lambda
+# deploy stacks, and its services may read the environment's SSM parameters until they are gone.
+TEARDOWN_DEPENDENCIES = collections.OrderedDict([
+    ('', []), # The pull request pipeline itself
+    ('-ecs-main-deploy', []),
+    ('-ec2-deploy', ['-ecs-main-deploy']),
+    ('-lambda-deploy', ['-ecs-main-deploy']),
+    ('-ssm-environments-deploy', ['-ecs-main-deploy'])
+])
+
+def teardown_stacks(stack_name, dependencies=TEARDOWN_DEPENDENCIES):
+    """Deletes the pull request stacks, concurrently except where one stack must wait on another.
+
+    Only stacks that others depend on are waited on. Returns the per stack timings in teardown order, where
+    duration_ms is the time the deletion took for waited stacks, but only the delete_stack request for the others.
+    """
+    dependents = {suffix for suffixes in dependencies.values() for suffix in suffixes}
+    start = time.time()
+
+    def delete(suffix, futures):
+        for dependency in dependencies[suffix]:
+            futures[dependency].result()
+        started = time.time()
+        print('Deleting stack {0}'.format(stack_name + suffix))
+        cloudformation_client.delete_stack(StackName=stack_name + suffix)
+        if suffix in dependents:
+            print('Waiting on stack {0} deletion...'.format(stack_name + suffix))
+            cloudformation_client.get_waiter('stack_delete_complete').wait(
+                StackName=stack_name + suffix, WaiterConfig={'Delay': 5, 'MaxAttempts': 170})
+        return {
+            'stack_name': stack_name + suffix,
+            'started_after_ms': int((started - start) * 1000),
+            'duration_ms': int((time.time() - started) * 1000),
+            'waited': suffix in dependents
+        }
+
+    # One thread per stack, so stacks blocked on a dependency never starve the others.
+    with ThreadPoolExecutor(max_workers=len(dependencies)) as executor:
+        futures = {}
+        for suffix in dependencies:
+            futures[suffix] = executor.submit(delete, suffix, futures)
+        return [futures[suffix].result() for suffix in dependencies]
+
+def enqueue_job(job):
+    # Jobs are delayed by the coalescing window, so that only the latest event of a burst does any work.
+    response = sqs_client.send_message(
+        QueueUrl=os.environ['WEBHOOK_QUEUE_URL'],
+        MessageBody=json.dumps(job),
+        DelaySeconds=COALESCE_WINDOW_SECONDS
+    )
+    print('Queued job {0}: {1}'.format(response['MessageId'], job))
+
+def get_stack_name(job):
+    return '{repo_name}-pull-request-{source_branch}-{pull_request_number}'.format(
+        repo_name=job['repo_name'],
+        source_branch=job['source_branch'].replace('_', '-'),
+        pull_request_number=job['pull_request_number']
+    )
+
+def process_job(job):
+    """Creates, updates or deletes the pull request pipeline stacks for a job queued by lambda_handler."""
+    print('Processing job: ', job)
+    repo_name = job['repo_name']
+    source_branch = job['source_branch']
+    pull_request_number = job['pull_request_number']
+
+    stack_name = get_stack_name(job)
+    print('stack_name: ', stack_name)
+
+    latest_delivery_id = dedup_store.get_latest(stack_name)
+    if job['delivery_id'] and latest_delivery_id not in (None, job['delivery_id']):
+        print('Skipping delivery {0}, superseded by delivery {1}'.format(job['delivery_id'], latest_delivery_id))
+        return
+
+    template_name = 'template-pull-request-pipeline.json'
+    template_url = 'https://s3.amazonaws.com/{0}/cloudformation/{1}'.format(
+        get_microservice_bucket_name(), template_name)
+
+    print('template_url: ', template_url)
+
+    parameters=[
+        {'ParameterKey': 'ProjectName', 'ParameterValue': os.environ['PROJECT_NAME']},
+        {'ParameterKey': 'ProjectDescription', 'ParameterValue': os.environ['PROJECT_DESCRIPTION']},
+        {'ParameterKey': 'CodePipelineBucketName', 'ParameterValue': os.environ['CODE_PIPELINE_BUCKET_NAME']},
+        {'ParameterKey': 'CodeBuildDockerImage', 'ParameterValue': os.environ['CODE_BUILD_DOCKER_IMAGE']},
+        {'ParameterKey': 'CodeBuildServiceRoleArn', 'ParameterValue': os.environ['CODE_BUILD_SERVICE_ROLE_ARN']},
+        {'ParameterKey': 'CodePipelineServiceRoleArn', 'ParameterValue': os.environ['CODE_PIPELINE_SERVICE_ROLE_ARN']},
+        {'ParameterKey': 'LambdaBucketName', 'ParameterValue': os.environ['LAMBDA_BUCKET_NAME']},
+        {'ParameterKey': 'PipelineName', 'ParameterValue': stack_name},
+        {'ParameterKey': 'GitHubOrganization', 'ParameterValue': os.environ['GITHUB_ORGANIZATION']},
+        {'ParameterKey': 'RepoName', 'ParameterValue': repo_name},
+        {'ParameterKey': 'PullRequestNumber', 'ParameterValue': pull_request_number},
+        {'ParameterKey': 'SourceBranch', 'ParameterValue': source_branch},
+        {'ParameterKey': 'Token', 'ParameterValue': get_github_access_token()},
+        {'ParameterKey': 'IAMRole', 'ParameterValue': os.environ['IAM_ROLE']}
+    ]
+
+    pull_request_state = job['state']
+
+    if pull_request_state == "closed":
+        print('Deleting pull request stacks')
+        for result in teardown_stacks(stack_name):
+            if result['waited']:
+                print('Deleted {stack_name} in {duration_ms}ms (started after {started_after_ms}ms)'.format(**result))
+            else:
+                print('Requested deletion of {stack_name} in {duration_ms}ms (started after {started_after_ms}ms, '
+                      'not waited on)'.format(**result))
+    elif pull_request_state == "open":
+        stack = describe_stack(stack_name)
+        fingerprint = get_stack_fingerprint(
+            get_template_etag(get_microservice_bucket_name(), template_name), parameters)
+        if stack and get_fingerprint_tag(stack) == fingerprint:
+            print('Stack {0} is up to date with its template and parameters, skipping update.'.format(stack_name))
+            return
+        print('{0} stack'.format('Updating' if stack else 'Creating'))
+        try:
+            create_or_update_stack(
+                create=stack is None, stack_name=stack_name, template_url=template_url,
+                parameters=parameters, pull_request_number=pull_request_number, fingerprint=fingerprint)
+        except botocore.exceptions.ClientError as e:
+            # Anything else is re-raised, so SQS retries the job and then moves it to the dead letter queue.
+            if 'No updates are to be performed' not in str(e):
+                raise
+            print('Stack {0} does not need to be updated.'.format(stack_name))
+    else:
+        print('Unknown pull request state: ', pull_request_state)
+
+def worker_handler(event, context):
+    """Processes the jobs queued by lambda_handler (SQS event source, see template-github-webhook.json)."""
+    for record in event['Records']:
+        process_job(json.loads(record['body']))
+
 def lambda_handler(event, context):
-    print(event)
+    print('Received {0} event, delivery {1}'.format(
+        event['headers'].get('X-GitHub-Event'), event['headers'].get('X-GitHub-Delivery')))
 
     # I used Lambda proxy integration here.
     github_signature = event['headers']['X-Hub-Signature']
-    secret = get_github_pull_request_secret()
-    signature = hmac.new(secret.encode(), event['body'].encode(), "sha1")
-    expected_signature = 'sha1=' + signature.hexdigest()
+    raw_body = get_raw_body(event)
+    valid = is_valid_signature(github_signature, raw_body, get_github_pull_request_secret)
 
-    print('github_signature: ', github_signature)
-    print('expected_signature: ', expected_signature)
-
-    if not hmac.compare_digest(github_signature, expected_signature):
+    if not valid:
         return {
             "isBase64Encoded" : "false",
             "statusCode": "401",
@@ -108,129 +251,50 @@ def lambda_handler(event, context):
         }
     else:
         # For a full list of events: https://developer.github.com/v3/activity/events/types/#pullrequestevent
-        print('EVENT:')
-        print(event)
-        json_obj = json.dumps(event, indent=4)
-        print('JSON_OBJECT:')
-        print(json_obj)
-        obj = json.loads(json_obj, object_hook=JSONObject)
-        print('OBJECT:')
-        print(obj)
-        body = json.loads(obj.body, object_hook=JSONObject)
-        print('BODY:')
-        print(body)
-
-        if not hasattr(body, 'pull_request'):
-            raise Exception('Object is not a pull request!')
-
-        repo_name = body.pull_request.head.repo.name # reponame
-        source_branch = body.pull_request.head.ref # The pull request branch name
-        pull_request_number = str(body.pull_request.number) # Unique ID for the pull request within this repo.
-
-        stack_name = '{repo_name}-pull-request-{source_branch}-{pull_request_number}'.format(
-            repo_name=repo_name,
-            source_branch=source_branch.replace('_', '-'),
-            pull_request_number=pull_request_number
-        )
-        print('stack_name: ', stack_name)
-
-        template_name = 'template-pull-request-pipeline.json'
-        template_url = 'https://s3.amazonaws.com/{0}/cloudformation/{1}'.format(
-            get_microservice_bucket_name(), template_name)
-
-        print('template_url: ', template_url)
-
-        parameters=[
-            {'ParameterKey': 'ProjectName', 'ParameterValue': os.environ['PROJECT_NAME']},
-            {'ParameterKey': 'ProjectDescription', 'ParameterValue': os.environ['PROJECT_DESCRIPTION']},
-            {'ParameterKey': 'CodePipelineBucketName', 'ParameterValue': os.environ['CODE_PIPELINE_BUCKET_NAME']},
-            {'ParameterKey': 'CodeBuildDockerImage', 'ParameterValue': os.environ['CODE_BUILD_DOCKER_IMAGE']},
-            {'ParameterKey': 'CodeBuildServiceRoleArn', 'ParameterValue': os.environ['CODE_BUILD_SERVICE_ROLE_ARN']},
-            {'ParameterKey': 'CodePipelineServiceRoleArn', 'ParameterValue': os.environ['CODE_PIPELINE_SERVICE_ROLE_ARN']},
-            {'ParameterKey': 'LambdaBucketName', 'ParameterValue': os.environ['LAMBDA_BUCKET_NAME']},
-            {'ParameterKey': 'PipelineName', 'ParameterValue': stack_name},
-            {'ParameterKey': 'GitHubOrganization', 'ParameterValue': os.environ['GITHUB_ORGANIZATION']},
-            {'ParameterKey': 'RepoName', 'ParameterValue': repo_name},
-            {'ParameterKey': 'PullRequestNumber', 'ParameterValue': pull_request_number},
-            {'ParameterKey': 'SourceBranch', 'ParameterValue': source_branch},
-            {'ParameterKey': 'Token', 'ParameterValue': get_github_access_token()},
-            {'ParameterKey': 'IAMRole', 'ParameterValue': os.environ['IAM_ROLE']}
-        ]
-        print('Parameters: ', parameters)
-
-        pull_request_state = body.pull_request.state
-
-        if pull_request_state == "closed":
-            print('Deleting Pipeline Stack')
-            # Delete the pipeline stack
-            response = cloudformation_client.delete_stack(
-              StackName=stack_name
-            )
-            print(response)
-
-            print('Deleting ECS Main Deploy Stack')
-            # Delete the ECS MAIN Task deploy stack
-            main_deploy_stack_name = '{0}-{1}-{2}-{3}'.format(stack_name, 'ecs', 'main', 'deploy')
-            print(main_deploy_stack_name)
-            response = cloudformation_client.delete_stack(
-              StackName=main_deploy_stack_name
-            )
-            print(response)
-
-            print('Waiting on ECS Main Deploy Stack deletion...')
-            main_deploy_waiter = cloudformation_client.get_waiter('stack_delete_complete')
-            main_deploy_waiter.wait(StackName=main_deploy_stack_name)
-
-            print('Deleting EC2 Deploy Stack')
-            # Delete the EC2 deploy stack
-            response = cloudformation_client.delete_stack(
-              StackName='{0}-{1}-{2}'.format(stack_name, 'ec2', 'deploy')
-            )
-            print(response)
-
-            print('Deleting Lambda Stack')
-            # Delete the EC2 deploy stack
-            response = cloudformation_client.delete_stack(
-              StackName='{0}-{1}-{2}'.format(stack_name, 'lambda', 'deploy')
-            )
-            print(response)
-
-            print('Deleting SSM Environments Parameter Stack')
-            # Delete the EC2 deploy stack
-            response = cloudformation_client.delete_stack(
-              StackName='{0}-{1}-{2}'.format(stack_name, 'ssm-environments', 'deploy')
-            )
-            print(response)
-        elif pull_request_state == "open":
-            print('Creating or Updating stack')
-            print('Attempting to create stack')
-            try:
-                create_or_update_stack(
-                    create=True, stack_name=stack_name, template_url=template_url,
-                    parameters=parameters, pull_request_number=pull_request_number)
-            except Exception as e:
-                print('Stack may have already been created, and that is OK.')
-                print('Error: {0}'.format(e))
-                print('Attempting to update stack')
-                try:
-                  create_or_update_stack(
-                      create=False, stack_name=stack_name, template_url=template_url,
-                      parameters=parameters, pull_request_number=pull_request_number)
-                except Exception as ex:
-                    print('Stack may not need to be updated.')
-                    print('Error: {0}'.format(ex))
-                    print('Continuing as normal. There is no need to update the stack once it is deleted')
-        else:
-            print('Unknown pull request state: ', pull_request_state)
-
+        # Only what the worker needs to rebuild the stack names and parameters.
+        job = parse_pull_request_event(raw_body)
+        job['delivery_id'] = event['headers'].get('X-GitHub-Delivery')
+        print('JOB: ', job)
+
+        if job['delivery_id']:
+            # GitHub redelivers events, and bursts of pushes each send a 'synchronize' event.
+            if not dedup_store.add_if_absent('delivery:' + job['delivery_id'], DEDUP_TTL_SECONDS):
+                print('Ignoring duplicate delivery {0}'.format(job['delivery_id']))
+                return {
+                    "isBase64Encoded" : "false",
+                    "statusCode": "200",
+                    "headers": {},
+                    "body": "Duplicate delivery!"
+                }
+            dedup_store.set_latest(get_stack_name(job), job['delivery_id'], DEDUP_TTL_SECONDS)
+
+        try:
+            if not os.environ.get('WEBHOOK_QUEUE_URL'):
+                # No worker deployed, so orchestrate the stacks before responding.
+                process_job(job)
+                return {
+                    "isBase64Encoded" : "false",
+                    "statusCode": "200",
+                    "headers": {},
+                    "body": "Success!"
+                }
+
+            # Stack deletion can take longer than GitHub's 10 second webhook timeout, so hand the
+            # job to the worker Lambda and acknowledge right away.
+            enqueue_job(job)
+        except Exception:
+            # Forget the delivery, so that GitHub's redelivery of this event isn't dropped as a duplicate.
+            # The latest marker is left pointing at this delivery, which its redelivery matches.
+            if job['delivery_id']:
+                dedup_store.remove('delivery:' + job['delivery_id'])
+            raise
         return {
             "isBase64Encoded" : "false",
-            "statusCode": "200",
+            "statusCode": "202",
             "headers": {},
-            "body": "Success!"
+            "body": "Accepted!"
         }
 
-
 MONTH_EMOJI_MAP = {
     10: ':jack_o_lantern: :white_check_mark: :ghost:',
     12: ':christmas_tree: :white_check_mark: :gift:'
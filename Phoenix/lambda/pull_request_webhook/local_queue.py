@@ -0,0 +1,47 @@
+""" A local, in-memory stand-in for the SQS job queue used by the pull request webhook.
+
+USAGE:
+  import lambda_function
+  from local_queue import LocalQueue
+
+  queue = LocalQueue()
+  lambda_function.sqs_client = queue
+  os.environ['WEBHOOK_QUEUE_URL'] = 'local'
+
+  lambda_function.lambda_handler(event, None)  # Returns 202 and queues a job.
+  lambda_function.lambda_handler(event, None)  # Returns 200, the same X-GitHub-Delivery is a duplicate.
+  queue.drain(lambda_function.worker_handler)  # Runs the queued jobs as the worker Lambda would.
+"""
+
+import uuid
+
+
+class LocalQueue(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=0):
+        # Messages are never delayed locally, drain() runs them when called.
+        message_id = str(uuid.uuid4())
+        self.messages.append({'messageId': message_id, 'body': MessageBody, 'eventSource': 'aws:sqs'})
+        return {'MessageId': message_id}
+
+    def receive_event(self, batch_size=1):
+        """Removes up to batch_size messages and returns them as an SQS Lambda event."""
+        records, self.messages = self.messages[:batch_size], self.messages[batch_size:]
+        return {'Records': records}
+
+    def drain(self, handler, batch_size=1):
+        """Invokes the handler with every queued message. Returns the number of messages processed."""
+        count = 0
+        while self.messages:
+            event = self.receive_event(batch_size)
+            try:
+                handler(event, None)
+            except Exception:
+                # Like SQS, failed messages become visible again.
+                self.messages = event['Records'] + self.messages
+                raise
+            count += len(event['Records'])
+        return count
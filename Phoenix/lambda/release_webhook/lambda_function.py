@@ -5,89 +5,87 @@ import botocore
 import requests
 from datetime import datetime
 import urllib.parse
-import hmac
 import re
-import base64
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from github_webhook import (SSMConfig, FINGERPRINT_TAG_KEY, get_raw_body, is_valid_signature, describe_stack,
+                            get_template_etag, get_stack_fingerprint, get_fingerprint_tag)
 
 # Handler for receiving release events from GitHub.
 
 # https://developer.github.com/v3/activity/events/types/#pushevent
 
 cloudformation_client = boto3.client('cloudformation')
-ssm_client = boto3.client('ssm')
 
 GITHUB_API_URL = 'https://api.github.com'
 
-class JSONObject:
-  def __init__(self, dict):
-      vars(self).update(dict)
+# Secrets and config are cached for the life of a warm container (see github_webhook.py).
+config = SSMConfig({
+    '/microservice/{0}/global/github/access-token'.format(os.environ['PROJECT_NAME']): 'access_token',
+    '/microservice/{0}/global/github/release-secret'.format(os.environ['PROJECT_NAME']): 'release_secret',
+    '/microservice/{0}/global/bucket-name'.format(os.environ['PROJECT_NAME']): 'bucket_name',
+    '/microservice/{0}/global/release-environments'.format(os.environ['PROJECT_NAME']): 'release_environments',
+})
 
-# Assign python values to values return from gitlab JSON reqeuest object
-false = False
-true = True
-null = None
+def get_config(refresh=False):
+    return config.get(refresh)
 
 def get_github_access_token():
-    print('getting github access token')
-    response = ssm_client.get_parameter(
-        Name='/microservice/{0}/global/github/access-token'.format(os.environ['PROJECT_NAME']),
-        WithDecryption=True
-    )
-    return response['Parameter']['Value']
-
-def get_github_release_secret():
-    print('getting github release secret')
-    response = ssm_client.get_parameter(
-        Name='/microservice/{0}/global/github/release-secret'.format(os.environ['PROJECT_NAME']),
-        WithDecryption=True
-    )
-    return response['Parameter']['Value']
+    return get_config()['access_token']
+
+def get_github_release_secret(refresh=False):
+    return get_config(refresh)['release_secret']
 
 def get_microservice_bucket_name():
-    response = ssm_client.get_parameter(
-        Name='/microservice/{0}/global/bucket-name'.format(os.environ['PROJECT_NAME']),
-        WithDecryption=False
-    )
-    return response['Parameter']['Value']
+    return get_config()['bucket_name']
 
 
 def get_release_environments():
-    response = ssm_client.get_parameter(
-        Name='/microservice/{0}/global/release-environments'.format(os.environ['PROJECT_NAME']),
-        WithDecryption=False
-    )
-    result = response['Parameter']['Value']
+    result = get_config()['release_environments']
     return [val.strip() for val in result.split(',')]  # ['staging', 'qa', ...]
 
 
-def create_or_update_stack(create, stack_name, template_url, parameters):
+def parse_push_event(raw_body):
+    """Returns only the fields of a push event that the handler uses."""
+    payload = json.loads(raw_body.decode('utf-8'))
+    if 'pusher' not in payload:
+        raise Exception('Object is not a push request!')
+    return {
+        'repo_name': payload['repository']['name'],
+        'ref': payload['ref'],
+        'before': payload['before'],
+        'after': payload['after']
+    }
+
+
+def get_existing_stacks(stack_names):
+    """Returns a map of the given stack names that exist to their stacks, describing the stacks concurrently."""
+    stack_names = list(stack_names)
+    with ThreadPoolExecutor(max_workers=max(len(stack_names), 1)) as executor:
+        stacks = executor.map(describe_stack, stack_names)
+        return {stack_name: stack for stack_name, stack in zip(stack_names, stacks) if stack}
+
+
+def create_or_update_stack(create, stack_name, template_url, parameters, fingerprint):
+    tags = [{'Key': FINGERPRINT_TAG_KEY, 'Value': fingerprint}]
     if create:
         response = cloudformation_client.create_stack(
           StackName=stack_name,
           TemplateURL=template_url,
           Parameters=parameters,
-          Capabilities=['CAPABILITY_IAM']
+          Capabilities=['CAPABILITY_IAM'],
+          Tags=tags
         )
     else:
         response = cloudformation_client.update_stack(
           StackName=stack_name,
           TemplateURL=template_url,
           Parameters=parameters,
-          Capabilities=['CAPABILITY_IAM']
+          Capabilities=['CAPABILITY_IAM'],
+          Tags=tags
         )
 
 
-def delete_stack_if_exists(stack_name):
-    # Idempotent way to delete a CloudFormation stack.
-    try:
-        print('Attempting to delete stack {0}'.format(stack_name))
-        response = cloudformation_client.delete_stack(StackName=stack_name)
-        return response
-    except Exception as e:
-        print('Error: {0}'.format(e))
-        print('Stack {0} may not exist. Skipping delete.'.format(stack_name))
-
-
 def success_response():
     return {
         "isBase64Encoded" : "false",
@@ -97,18 +95,15 @@ def success_response():
     }
 
 def lambda_handler(event, context):
-    print(event)
+    print('Received {0} event, delivery {1}'.format(
+        event['headers'].get('X-GitHub-Event'), event['headers'].get('X-GitHub-Delivery')))
 
     # I used Lambda proxy integration here.
     github_signature = event['headers']['X-Hub-Signature']
-    secret = get_github_release_secret()
-    signature = hmac.new(secret.encode(), event['body'].encode(), "sha1")
-    expected_signature = 'sha1=' + signature.hexdigest()
-
-    print('github_signature: ', github_signature)
-    print('expected_signature: ', expected_signature)
+    raw_body = get_raw_body(event)
+    valid = is_valid_signature(github_signature, raw_body, get_github_release_secret)
 
-    if not hmac.compare_digest(github_signature, expected_signature):
+    if not valid:
         return {
             "isBase64Encoded" : "false",
             "statusCode": "401",
@@ -117,29 +112,17 @@ def lambda_handler(event, context):
         }
     else:
         # For a full list of events: https://developer.github.com/v3/activity/events/types/#pushevent
-        print('EVENT:')
-        print(event)
-        json_obj = json.dumps(event, indent=4)
-        print('JSON_OBJECT:')
-        print(json_obj)
-        obj = json.loads(json_obj, object_hook=JSONObject)
-        print('OBJECT:')
-        print(obj)
-        body = json.loads(obj.body, object_hook=JSONObject)
-        print('BODY:')
-        print(body)
-
-        if not hasattr(body, 'pusher'):
-            raise Exception('Object is not a push request!')
-
-        repo_name = body.repository.name
-        _, ref_type, ref_name = body.ref.split("/")
+        push = parse_push_event(raw_body)
+        print('PUSH: ', push)
+
+        repo_name = push['repo_name']
+        _, ref_type, ref_name = push['ref'].split("/")
         is_tag, is_branch = ref_type == "tags", ref_type == "heads"
         if not is_branch:
             return success_response()
 
-        is_create_branch_push_event = body.before == '0000000000000000000000000000000000000000'
-        is_delete_branch_push_event = body.after == '0000000000000000000000000000000000000000'
+        is_create_branch_push_event = push['before'] == '0000000000000000000000000000000000000000'
+        is_delete_branch_push_event = push['after'] == '0000000000000000000000000000000000000000'
         print('is_create_branch_push_event: ', is_create_branch_push_event)
         print('is_delete_branch_push_event: ', is_delete_branch_push_event)
 
@@ -151,18 +134,24 @@ def lambda_handler(event, context):
             # We only care about release branches.
             return success_response()
 
+        # Read everything the environments share once, before fanning out.
         release_environments = get_release_environments()
-
-        for release_environment in release_environments:
-            stack_name = '{repo_name}-{release_environment}-{source_branch}'.format(
+        template_name = 'template-release-environment-pipeline.json'
+        template_url = 'https://s3.amazonaws.com/{0}/cloudformation/{1}'.format(
+            get_microservice_bucket_name(), template_name)
+        token = get_github_access_token()
+        template_etag = None if is_delete_branch_push_event else get_template_etag(
+            get_microservice_bucket_name(), template_name)
+
+        stack_names = collections.OrderedDict(
+            (release_environment, '{repo_name}-{release_environment}-{source_branch}'.format(
                 repo_name=repo_name, release_environment=release_environment,
                 source_branch=ref_name.replace('_', '-')
-            )
-
-            template_name = 'template-release-environment-pipeline.json'
-            template_url = 'https://s3.amazonaws.com/{0}/cloudformation/{1}'.format(
-                get_microservice_bucket_name(), template_name)
+            )) for release_environment in release_environments)
+        existing_stacks = get_existing_stacks(set(stack_names.values()))
 
+        def provision(release_environment):
+            stack_name = stack_names[release_environment]
             parameters=[
                 {'ParameterKey': 'ProjectName', 'ParameterValue': os.environ['PROJECT_NAME']},
                 {'ParameterKey': 'ProjectDescription', 'ParameterValue': os.environ['PROJECT_DESCRIPTION']},
@@ -176,34 +165,42 @@ def lambda_handler(event, context):
                 {'ParameterKey': 'RepoName', 'ParameterValue': repo_name},
                 {'ParameterKey': 'SourceBranch', 'ParameterValue': ref_name},
                 {'ParameterKey': 'ReleaseEnvironment', 'ParameterValue': release_environment},
-                {'ParameterKey': 'Token', 'ParameterValue': get_github_access_token()},
+                {'ParameterKey': 'Token', 'ParameterValue': token},
                 {'ParameterKey': 'IAMRole', 'ParameterValue': os.environ['IAM_ROLE']}
             ]
+            stack = existing_stacks.get(stack_name)
+            result = {'environment': release_environment, 'stack_name': stack_name}
 
             if is_delete_branch_push_event:
-                print('Deleting Pipeline Stack')
-                # Delete the pipeline stack
-                response = delete_stack_if_exists(stack_name)
-                print(response)
+                result['action'] = 'delete'
+                if not stack:
+                    result['result'] = 'skipped, stack does not exist'
+                    return result
             else:
-                print('Creating or Updating stack')
-                print('Attempting to create stack')
-                try:
+                result['action'] = 'update' if stack else 'create'
+                fingerprint = get_stack_fingerprint(template_etag, parameters)
+                if stack and get_fingerprint_tag(stack) == fingerprint:
+                    result['result'] = 'skipped, template and parameters unchanged'
+                    return result
+            try:
+                if is_delete_branch_push_event:
+                    cloudformation_client.delete_stack(StackName=stack_name)
+                else:
                     create_or_update_stack(
-                        create=True, stack_name=stack_name, template_url=template_url,
-                        parameters=parameters)
-                except Exception as e:
-                    print('Stack may have already been created, and that is OK.')
-                    print('Error: {0}'.format(e))
-                    print('Attempting to update stack')
-                    try:
-                        create_or_update_stack(
-                            create=False, stack_name=stack_name, template_url=template_url,
-                            parameters=parameters)
-                    except Exception as ex:
-                        print('Stack may not need to be updated.')
-                        print('Error: {0}'.format(ex))
-                        print('Continuing as normal.')
+                        create=not stack, stack_name=stack_name, template_url=template_url,
+                        parameters=parameters, fingerprint=fingerprint)
+                result['result'] = 'submitted'
+            except botocore.exceptions.ClientError as e:
+                if 'No updates are to be performed' in str(e):
+                    result['result'] = 'no changes'
+                else:
+                    result['result'] = 'error: {0}'.format(e)
+            return result
+
+        with ThreadPoolExecutor(max_workers=len(release_environments)) as executor:
+            results = list(executor.map(provision, release_environments))
+        for result in results:
+            print('{environment}: {action} {stack_name}: {result}'.format(**result))
 
         return {
             "isBase64Encoded" : "false",
@@ -0,0 +1,89 @@
+""" Sends the response of a CloudFormation Lambda-backed custom resource to its pre-signed ResponseURL.
+
+A response that never arrives leaves the stack waiting for up to an hour, so compared to a bare requests.put, the
+sender:
+  - Reuses one keep-alive requests.Session for the life of a warm Lambda container.
+  - Sets a connect/read timeout on the request.
+  - Retries connection errors and 5xx responses with exponential backoff and full jitter. The PUT to the pre-signed
+    S3 URL is idempotent, so retrying it is safe. Retries stop when the Lambda function doesn't have the time left
+    for the backoff and another request, so it doesn't time out mid-retry.
+  - Serializes the payload once.
+  - Sends a FAILED response instead when the Data is over the MAX_DATA_BYTES limit of CloudFormation, so the reason
+    shows up in the stack events.
+  - Logs how long the response took to send, and in how many attempts.
+
+USAGE:
+  from cfn_response import send_response
+
+  send_response(event, context, 'SUCCESS', {'Arn': arn}, 'N/A')
+  send_response(event, context, 'SUCCESS', {'Password': password}, 'N/A', log_hidden_keys=['Password'])
+  send_response(event, context, 'FAILED', {}, str(e), physical_resource_id=context.log_stream_name)
+"""
+
+import json
+import time
+import uuid
+import random
+import requests
+from requests.adapters import HTTPAdapter
+
+TIMEOUT_SECONDS = (3.05, 10)  # (connect, read)
+MAX_RETRIES = 4
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 8
+MAX_DATA_BYTES = 4096  # CloudFormation rejects responses with more Data than this.
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_maxsize=1))
+
+
+def send_response(event, context, response_status, response_data, reason='N/A', physical_resource_id=None,
+                  log_hidden_keys=(), sleep=time.sleep):
+    """Send a Success or Failure event back to CFN stack. Returns the response, or None if it couldn't be sent."""
+    data_bytes = len(json.dumps(response_data, default=str).encode('utf-8'))
+    if data_bytes > MAX_DATA_BYTES:
+        response_status = 'FAILED'
+        reason = 'Response data is {0} bytes, over the {1} byte limit'.format(data_bytes, MAX_DATA_BYTES)
+        response_data = {}
+        print(reason)
+
+    payload = {
+        'StackId': event['StackId'],
+        'Status': response_status,
+        'Reason': reason,
+        'PhysicalResourceId': physical_resource_id or event.get('PhysicalResourceId', str(uuid.uuid4())),
+        'RequestId': event['RequestId'],
+        'LogicalResourceId': event['LogicalResourceId'],
+        'Data': response_data
+    }
+    body = json.dumps(payload, default=str)
+    if any(key in response_data for key in log_hidden_keys):
+        # Don't display secrets such as passwords in logs
+        safe_data = {key: value for key, value in response_data.items() if key not in log_hidden_keys}
+        print('Sending {0} to {1}'.format(json.dumps(dict(payload, Data=safe_data), default=str), event['ResponseURL']))
+    else:
+        print('Sending {0} to {1}'.format(body, event['ResponseURL']))
+
+    start = time.time()
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            response = session.put(event['ResponseURL'], data=body, timeout=TIMEOUT_SECONDS)
+            if response.status_code not in RETRY_STATUS_CODES:
+                print('Sent {0} response in {1:.0f} ms and {2} attempt(s), status code {3}'.format(
+                    response_status, (time.time() - start) * 1000, attempt + 1, response.status_code))
+                return response
+            print('Sending the response failed with status code {0}'.format(response.status_code))
+        except requests.exceptions.RequestException as e:
+            print('Sending the response failed: {0}'.format(e))
+        if attempt == MAX_RETRIES:
+            break
+        backoff = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+        if context is not None and context.get_remaining_time_in_millis() < (backoff + sum(TIMEOUT_SECONDS)) * 1000:
+            print('Not retrying, only {0} ms left before the function times out'.format(
+                context.get_remaining_time_in_millis()))
+            break
+        sleep(backoff)
+    print('Could not send {0} response after {1:.0f} ms and {2} attempts'.format(
+        response_status, (time.time() - start) * 1000, attempt + 1))
+    return None
@@ -0,0 +1,109 @@
+""" A runtime for CloudFormation Lambda-backed custom resources that may not finish within one invocation.
+
+CloudFormation waits up to an hour for a custom resource to respond, so a function that times out before calling
+send_response leaves the stack hanging. run() makes sure that every request gets exactly one response:
+  - The work function is given a has_time() function, which turns False once the invocation is within a margin of
+    its timeout (a quarter of the time left when the invocation started, up to TIME_MARGIN_MILLIS).
+  - Work that stops early returns a checkpoint of what's left. The event is re-sent to the function asynchronously
+    with the checkpoint and the invocation count added, and the next invocation picks up from the checkpoint.
+    get_work_seconds() tells how much time the work gets across all the invocations.
+    Checkpoints should stay small: an event over the 256 KB limit of asynchronous invocations fails the request.
+    Only the invocation that finishes, fails or runs out of invocations sends a response.
+  - If the work doesn't return in time (a call that hangs, or work that doesn't check has_time()), a watchdog
+    thread sends a FAILED response just before the function times out.
+  - Exceptions send a FAILED response with the exception as the reason.
+
+Responses are sent with cfn_response.send_response, unless another send_response function is given.
+
+USAGE:
+  import custom_resource
+
+  def delete_repos(event, checkpoint, has_time):
+      # Returns (response_data, checkpoint), where a checkpoint of None means the work is done.
+      repo_names = event['ResourceProperties']['RepoNames'] if checkpoint is None else checkpoint
+      while repo_names and has_time():
+          delete_repo(repo_names.pop())
+      return {}, repo_names or None
+
+  def lambda_handler(event, context):
+      print(json.dumps(event, indent=2))
+      custom_resource.run(event, context, delete_repos)
+"""
+
+import os
+import json
+import threading
+import boto3
+from cfn_response import send_response as cfn_send_response
+
+TIME_MARGIN_MILLIS = int(os.environ.get('CUSTOM_RESOURCE_TIME_MARGIN_MILLIS', '30000'))
+MAX_INVOCATIONS = int(os.environ.get('CUSTOM_RESOURCE_MAX_INVOCATIONS', '20'))
+MAX_PAYLOAD_BYTES = 256 * 1024  # The most an asynchronous (Event) invocation accepts.
+CHECKPOINT_KEY = 'CustomResourceCheckpoint'
+INVOCATION_KEY = 'CustomResourceInvocation'
+
+lambda_client = boto3.client('lambda')
+
+
+def get_time_margin_millis(remaining_millis):
+    """The margin before the timeout at which has_time() turns False, for an invocation with this much time left."""
+    return min(TIME_MARGIN_MILLIS, remaining_millis // 4)
+
+
+def get_work_seconds(context, max_invocations=MAX_INVOCATIONS):
+    """The most time work gets across all the invocations, if each has as much time left as this one."""
+    remaining_millis = context.get_remaining_time_in_millis()
+    return (remaining_millis - get_time_margin_millis(remaining_millis)) / 1000.0 * max_invocations
+
+
+def run(event, context, work, send_response=cfn_send_response, max_invocations=MAX_INVOCATIONS):
+    """Runs work(event, checkpoint, has_time) and responds to CloudFormation, or re-invokes the function."""
+    invocation = event.get(INVOCATION_KEY, 1)
+    margin_millis = get_time_margin_millis(context.get_remaining_time_in_millis())
+    has_time = lambda: context.get_remaining_time_in_millis() > margin_millis
+    lock = threading.Lock()
+    responded = []
+
+    def respond(status, response_data, reason):
+        # Whichever of the work and the watchdog finishes first responds, the other does nothing.
+        with lock:
+            if responded:
+                return False
+            responded.append(status)
+        send_response(event, context, status, response_data, reason)
+        return True
+
+    def on_timeout():
+        print('Invocation {0} did not finish in time'.format(invocation))
+        respond('FAILED', {}, 'Timed out in invocation {0}'.format(invocation))
+
+    watchdog = threading.Timer(max(context.get_remaining_time_in_millis() - margin_millis // 2, 0) / 1000.0, on_timeout)
+    watchdog.daemon = True
+    watchdog.start()
+    try:
+        response_data, checkpoint = work(event, event.get(CHECKPOINT_KEY), has_time)
+        if checkpoint is None:
+            respond('SUCCESS', response_data, 'N/A')
+        elif invocation >= max_invocations:
+            respond('FAILED', response_data, 'Not finished after {0} invocations'.format(invocation))
+        else:
+            payload = json.dumps(dict(event, **{CHECKPOINT_KEY: checkpoint, INVOCATION_KEY: invocation + 1}))
+            if len(payload.encode('utf-8')) > MAX_PAYLOAD_BYTES:
+                raise Exception('The checkpoint makes the event {0} bytes, over the {1} byte limit'.format(
+                    len(payload.encode('utf-8')), MAX_PAYLOAD_BYTES))
+            with lock:
+                if responded:
+                    return
+                print('Invoking {0} to continue in invocation {1}'.format(context.invoked_function_arn, invocation + 1))
+                lambda_client.invoke(
+                    FunctionName=context.invoked_function_arn,
+                    InvocationType='Event',
+                    Payload=payload
+                )
+                # The next invocation responds, so the watchdog must not.
+                responded.append(None)
+    except Exception as e:
+        print(e)
+        respond('FAILED', {}, str(e))
+    finally:
+        watchdog.cancel()
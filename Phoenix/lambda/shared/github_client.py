@@ -0,0 +1,199 @@
+""" A GitHub REST API client shared by the Phoenix Lambda functions and pull_request_codebuild.py.
+
+Compared to bare requests.get/post calls, the client:
+  - Reuses one keep-alive requests.Session (and its TLS connections) for the life of a warm Lambda container.
+  - Sets a connect/read timeout on every request.
+  - Sends conditional GET requests with the ETag of the last response, and serves 304 responses from its cache.
+    GitHub doesn't count 304 responses against the rate limit.
+  - Honors Retry-After and X-RateLimit-Remaining/X-RateLimit-Reset, waiting up to RATE_LIMIT_MAX_WAIT_SECONDS.
+  - Retries 5xx responses and connection errors with exponential backoff and full jitter. POST requests are not
+    idempotent (e.g. issue comments), so they are only retried when GitHub didn't process them.
+  - Gets the access token before each request (callers cache it), and refreshes it once after a 401, in case
+    it was rotated.
+
+Responses are returned as requests.Response objects, whatever their status code.
+
+USAGE:
+  from github_client import GitHubClient
+
+  github = GitHubClient(get_github_access_token)  # A token, or a function returning one.
+  github = GitHubClient(get_github_access_token, lambda: get_github_access_token(refresh=True))
+  response = github.post('repos/{0}/{1}/issues/{2}/comments'.format(org, repo, number), {'body': 'Hello'})
+  response = github.get('repos/{0}/{1}/hooks'.format(org, repo))
+  hooks = github.get_all('repos/{0}/{1}/hooks'.format(org, repo))  # Follows the pagination links.
+
+  See Phoenix/local_github.py for a local stand-in for the GitHub API.
+"""
+
+import os
+import json
+import time
+import random
+import collections
+import requests
+from requests.adapters import HTTPAdapter
+
+GITHUB_API_URL = 'https://api.github.com'
+TIMEOUT_SECONDS = (3.05, 10)  # (connect, read)
+MAX_RETRIES = 4
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 8
+RATE_LIMIT_MAX_WAIT_SECONDS = int(os.environ.get('GITHUB_RATE_LIMIT_MAX_WAIT_SECONDS', '60'))
+ETAG_CACHE_SIZE = 128
+PER_PAGE = 100  # The maximum GitHub allows.
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'PATCH', 'DELETE')
+
+
+class GitHubClient(object):
+
+    def __init__(self, access_token, refresh_access_token=None, api_url=GITHUB_API_URL, timeout=TIMEOUT_SECONDS,
+                 max_retries=MAX_RETRIES, sleep=time.sleep):
+        # access_token is a token or a function returning one. After a 401, refresh_access_token is called
+        # if given, otherwise access_token is called again.
+        self.get_access_token = access_token if callable(access_token) else (lambda: access_token)
+        self.refresh_access_token = refresh_access_token or self.get_access_token
+        self.api_url = api_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.sleep = sleep
+        self.rate_limit_remaining = None
+        self.rate_limit_reset = None
+        self.etag_cache = collections.OrderedDict()  # url -> the last 200 response with an ETag
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=10))
+        self.session.headers.update({
+            'Accept': 'application/vnd.github.v3+json',
+            'User-Agent': 'phoenix-microservice',
+        })
+
+    def get(self, path, params=None, headers=None):
+        return self.request('GET', path, params=params, headers=headers)
+
+    def get_all(self, path, params=None):
+        """Returns the items of every page of a list endpoint, following the Link header."""
+        items = []
+        url, params = path, dict(params or {}, per_page=PER_PAGE)
+        while url:
+            response = self.get(url, params)
+            if response.status_code != 200:
+                raise Exception('GitHub GET {0} returned {1}: {2}'.format(
+                    response.url, response.status_code, response.text))
+            items.extend(response.json())
+            # The next link already has the query parameters.
+            url, params = response.links.get('next', {}).get('url'), None
+        return items
+
+    def post(self, path, data, headers=None):
+        return self.request('POST', path, data=data, headers=headers)
+
+    def patch(self, path, data, headers=None):
+        return self.request('PATCH', path, data=data, headers=headers)
+
+    def delete(self, path):
+        return self.request('DELETE', path)
+
+    def get_url(self, path):
+        if path.startswith('http://') or path.startswith('https://'):
+            return path
+        return '{0}/{1}'.format(self.api_url.rstrip('/'), path.lstrip('/'))
+
+    def request(self, method, path, data=None, params=None, headers=None):
+        # headers are added to the session headers, e.g. an Accept header for a preview API.
+        url = self.get_url(path)
+        cache_key = url + ('?' + json.dumps(params, sort_keys=True) if params else '')
+        body = json.dumps(data) if data is not None else None
+        refreshed_token = False
+        attempt = 0
+        while True:
+            self.wait_for_rate_limit()
+            if not refreshed_token:
+                access_token = self.get_access_token()
+            request_headers = dict(headers or {}, Authorization='token {0}'.format(access_token))
+            cached = self.etag_cache.get(cache_key) if method == 'GET' else None
+            if cached is not None:
+                request_headers['If-None-Match'] = cached.headers['ETag']
+
+            try:
+                response = self.session.request(
+                    method, url, data=body, params=params, headers=request_headers, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                # A connect timeout means the request never reached GitHub.
+                retryable = (method in IDEMPOTENT_METHODS or
+                             isinstance(e, requests.exceptions.ConnectTimeout))
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                print('GitHub {0} {1} failed ({2}), retrying'.format(method, url, e))
+                self.sleep(self.get_backoff(attempt))
+                attempt += 1
+                continue
+
+            self.update_rate_limit(response)
+
+            if response.status_code == 304 and cached is not None:
+                self.etag_cache.move_to_end(cache_key)
+                return cached
+
+            if response.status_code == 401 and not refreshed_token:
+                print('GitHub rejected the access token, refreshing it')
+                access_token = self.refresh_access_token()
+                refreshed_token = True
+                continue
+
+            delay = self.get_retry_delay(method, response, attempt)
+            if delay is not None:
+                print('GitHub {0} {1} returned {2}, retrying in {3:.2f}s'.format(
+                    method, url, response.status_code, delay))
+                self.sleep(delay)
+                self.rate_limit_remaining = None  # Already waited for the reset, if that was the reason.
+                attempt += 1
+                continue
+
+            if method == 'GET' and response.status_code == 200 and response.headers.get('ETag'):
+                self.etag_cache[cache_key] = response
+                self.etag_cache.move_to_end(cache_key)
+                if len(self.etag_cache) > ETAG_CACHE_SIZE:
+                    self.etag_cache.popitem(last=False)
+            return response
+
+    def get_retry_delay(self, method, response, attempt):
+        """Returns how long to wait before retrying the response, or None if it shouldn't be retried."""
+        if attempt >= self.max_retries:
+            return None
+        rate_limited = response.status_code == 429 or (
+            response.status_code == 403 and
+            (response.headers.get('X-RateLimit-Remaining') == '0' or 'Retry-After' in response.headers))
+        if rate_limited:
+            # GitHub didn't process the request, so any method can be retried.
+            if 'Retry-After' in response.headers:
+                delay = float(response.headers['Retry-After'])
+            elif self.rate_limit_remaining == 0 and self.rate_limit_reset:
+                delay = max(self.rate_limit_reset - time.time(), 0) + 1
+            else:
+                delay = self.get_backoff(attempt)
+            return delay if delay <= RATE_LIMIT_MAX_WAIT_SECONDS else None
+        if response.status_code in RETRY_STATUS_CODES and method in IDEMPOTENT_METHODS:
+            return self.get_backoff(attempt)
+        return None
+
+    def get_backoff(self, attempt):
+        # Full jitter: https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+        return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+    def update_rate_limit(self, response):
+        if 'X-RateLimit-Remaining' in response.headers:
+            self.rate_limit_remaining = int(response.headers['X-RateLimit-Remaining'])
+            self.rate_limit_reset = int(response.headers.get('X-RateLimit-Reset', 0))
+
+    def wait_for_rate_limit(self):
+        """Waits for the rate limit to reset when the last response used it up."""
+        if self.rate_limit_remaining != 0 or not self.rate_limit_reset:
+            return
+        delay = self.rate_limit_reset - time.time() + 1
+        if delay <= 0:
+            self.rate_limit_remaining = None
+        elif delay <= RATE_LIMIT_MAX_WAIT_SECONDS:
+            print('GitHub rate limit used up, waiting {0:.0f}s for it to reset'.format(delay))
+            self.sleep(delay)
+            self.rate_limit_remaining = None
+        # Otherwise the request is sent anyway, and GitHub's 403 is returned to the caller.
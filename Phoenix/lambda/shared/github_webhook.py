@@ -0,0 +1,107 @@
+""" Helpers shared by the GitHub webhook Lambda functions (pull_request_webhook and release_webhook).
+
+  - SSMConfig reads the secrets and config of a webhook from SSM with one batched call, and keeps them for the life
+    of a warm container. They are refreshed after SSM_CACHE_TTL_SECONDS, or early when a signature or a 401 suggests
+    a secret was rotated. Early refreshes are rate limited so that unsigned requests can't turn into an SSM read each.
+  - is_valid_signature checks the X-Hub-Signature of a delivery against the exact bytes GitHub sent.
+  - Stacks are tagged with a fingerprint of the template version and parameters they were last created or updated
+    with, so unchanged stacks can be skipped without calling update_stack.
+
+USAGE:
+  import github_webhook
+
+  config = github_webhook.SSMConfig({'/microservice/phoenix/global/github/release-secret': 'release_secret'})
+  get_secret = lambda refresh=False: config.get(refresh)['release_secret']
+
+  raw_body = github_webhook.get_raw_body(event)
+  if not github_webhook.is_valid_signature(event['headers']['X-Hub-Signature'], raw_body, get_secret):
+      ...
+
+  stack = github_webhook.describe_stack(stack_name)  # None if the stack does not exist.
+  fingerprint = github_webhook.get_stack_fingerprint(
+      github_webhook.get_template_etag(bucket_name, template_name), parameters)
+  if stack and github_webhook.get_fingerprint_tag(stack) == fingerprint:
+      ...  # Unchanged, skip the update.
+"""
+
+import os
+import json
+import time
+import hmac
+import base64
+import hashlib
+import boto3
+import botocore
+
+SSM_CACHE_TTL_SECONDS = int(os.environ.get('SSM_CACHE_TTL_SECONDS', '300'))
+SSM_MIN_REFRESH_SECONDS = 30
+FINGERPRINT_TAG_KEY = 'PhoenixFingerprint'
+
+cloudformation_client = boto3.client('cloudformation')
+ssm_client = boto3.client('ssm')
+s3_client = boto3.client('s3')
+
+
+class SSMConfig(object):
+
+    def __init__(self, names):
+        # names maps SSM parameter names to the keys of the values returned by get().
+        self.names = names
+        self.values = None
+        self.fetched_at = 0
+
+    def get(self, refresh=False):
+        age = time.time() - self.fetched_at
+        if self.values is None or age >= SSM_CACHE_TTL_SECONDS or (refresh and age >= SSM_MIN_REFRESH_SECONDS):
+            print('getting github secrets and config from SSM')
+            response = ssm_client.get_parameters(Names=list(self.names), WithDecryption=True)
+            if response['InvalidParameters']:
+                raise Exception('Missing SSM parameters: {0}'.format(response['InvalidParameters']))
+            self.values = {self.names[param['Name']]: param['Value'] for param in response['Parameters']}
+            self.fetched_at = time.time()
+        return self.values
+
+
+def get_raw_body(event):
+    # The signature is computed over the exact bytes GitHub sent.
+    if event.get('isBase64Encoded') in (True, 'true'):
+        return base64.b64decode(event['body'])
+    return event['body'].encode()
+
+
+def is_valid_signature(github_signature, raw_body, get_secret):
+    """Returns True if the signature matches. get_secret(refresh) returns the webhook secret. It is refreshed once
+    if the signature doesn't match, since the secret may have been rotated since it was cached."""
+    for refresh in (False, True):
+        signature = hmac.new(get_secret(refresh).encode(), raw_body, "sha1")
+        expected_signature = 'sha1=' + signature.hexdigest()
+
+        print('github_signature: ', github_signature)
+        print('expected_signature: ', expected_signature)
+        if hmac.compare_digest(github_signature, expected_signature):
+            return True
+    return False
+
+
+def describe_stack(stack_name):
+    # Returns None if the stack does not exist.
+    try:
+        return cloudformation_client.describe_stacks(StackName=stack_name)['Stacks'][0]
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'ValidationError' and 'does not exist' in str(e):
+            return None
+        raise
+
+
+def get_template_etag(bucket_name, template_name):
+    response = s3_client.head_object(Bucket=bucket_name, Key='cloudformation/{0}'.format(template_name))
+    return response['ETag'].strip('"')
+
+
+def get_stack_fingerprint(template_etag, parameters):
+    params = json.dumps(sorted((param['ParameterKey'], param['ParameterValue']) for param in parameters))
+    return hashlib.sha256('{0}:{1}'.format(template_etag, params).encode()).hexdigest()
+
+
+def get_fingerprint_tag(stack):
+    return next((tag['Value'] for tag in stack.get('Tags', []) if tag['Key'] == FINGERPRINT_TAG_KEY), None)
@@ -4,35 +4,15 @@ import boto3
 import botocore
 import random
 import string
-import requests
 from datetime import datetime
 import urllib.parse
-import uuid
 import hmac
+from cfn_response import send_response
 
 # Creates a secret in SSM parameter store
 
 ssm_client = boto3.client('ssm')
 
-def send_response(event, context, response_status, response_data, reason):
-    """Send a Success or Failure event back to CFN stack"""
-
-    payload = {
-        'StackId': event['StackId'],
-        'Status' : response_status,
-        'Reason' : reason,
-        'RequestId': event['RequestId'],
-        'LogicalResourceId': event['LogicalResourceId'],
-        'Data': response_data
-    }
-
-    payload['PhysicalResourceId'] = event.get(
-        'PhysicalResourceId', str(uuid.uuid4()))
-
-    print("Sending %s to %s" % (json.dumps(payload, default=str, indent=2), event['ResponseURL']))
-    requests.put(event['ResponseURL'], data=json.dumps(payload, default=str))
-    print("Sent %s to %s" % (json.dumps(payload, default=str, indent=2), event['ResponseURL']))
-
 def get_random_secret(secret_length=20):
     password = ''
     char_set = string.ascii_uppercase + string.ascii_lowercase + string.digits + '$'
@@ -0,0 +1,183 @@
+""" A local, in-memory stand-in for the GitHub REST API, for testing github_client.py and its callers.
+
+It serves plain HTTP on 127.0.0.1 from a background thread and keeps collections of JSON objects by path:
+  POST   {collection}       Adds the JSON body to the collection with a new 'id' and returns 201.
+  GET    {collection}       Returns a page of the collection (per_page and page query parameters, with a Link
+                            header like GitHub's), with an ETag. A matching If-None-Match returns 304.
+  GET    {collection}/{id}  Returns one item.
+  PATCH  {collection}/{id}  Updates one item.
+  DELETE {collection}/{id}  Removes one item and returns 204.
+
+Every request is recorded in 'requests', counts against 'rate_limit' (except 304 responses) and gets
+X-RateLimit-Remaining and X-RateLimit-Reset headers. When 'access_token' is set, other tokens get a 401.
+Responses can be scripted with fail_next(), e.g. to return a 502 or a 403 with Retry-After.
+
+It lives outside lambda/shared so that it isn't copied into the Lambda function zips.
+
+USAGE (from the Phoenix directory):
+  import sys
+  sys.path.append('lambda/shared')
+  from github_client import GitHubClient
+  from local_github import LocalGitHub
+
+  with LocalGitHub() as github_api:
+      github = GitHubClient('token', api_url=github_api.url)
+      github.post('repos/my-org/my-repo/hooks', {'config': {'url': 'https://example.com'}})
+      github_api.fail_next(502)
+      github.get('repos/my-org/my-repo/hooks')  # Retried after the 502. POST requests aren't retried on a 5xx.
+      github.get('repos/my-org/my-repo/hooks')  # Served from the client's cache after a 304.
+      print(github_api.requests)
+"""
+
+import json
+import time
+import hashlib
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs
+
+
+class LocalGitHub(object):
+
+    def __init__(self, access_token=None, rate_limit=5000):
+        self.access_token = access_token
+        self.rate_limit = rate_limit
+        self.rate_limit_reset = int(time.time()) + 3600
+        self.collections = {}
+        self.requests = []
+        self.scripted_responses = []
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.server = None
+        self.url = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.github = self
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fail_next(self, status, headers=None, body=None, count=1):
+        """Returns the given response for the next 'count' requests."""
+        for _ in range(count):
+            self.scripted_responses.append((status, headers or {}, body or {'message': 'Scripted failure'}))
+
+    def add(self, collection, item):
+        """Adds an item to a collection, e.g. add('/repos/my-org/my-repo/hooks', {...}). Returns the item."""
+        with self.lock:
+            item = dict(item, id=self.next_id)
+            self.next_id += 1
+            self.collections.setdefault(collection, []).append(item)
+            return item
+
+    def handle(self, method, path, headers, body, query=None):
+        """Returns (status, headers, body) for a request."""
+        query = query or {}
+        with self.lock:
+            self.requests.append({'method': method, 'path': path, 'query': query, 'headers': headers, 'body': body})
+            if self.scripted_responses:
+                status, response_headers, response_body = self.scripted_responses.pop(0)
+                return status, dict(self.get_rate_limit_headers(), **response_headers), response_body
+            if self.access_token and headers.get('Authorization') != 'token {0}'.format(self.access_token):
+                return 401, self.get_rate_limit_headers(), {'message': 'Bad credentials'}
+            if self.rate_limit <= 0:
+                return 403, self.get_rate_limit_headers(), {'message': 'API rate limit exceeded'}
+
+            collection, _, item_id = path.rstrip('/').rpartition('/')
+            response_headers = {}
+            if method == 'POST':
+                status, response_body = 201, None
+            elif item_id.isdigit() and collection in self.collections:
+                status, response_body = self.handle_item(method, collection, int(item_id), body)
+            elif method == 'GET':
+                status, response_body = 200, self.get_page(path.rstrip('/'), query, response_headers)
+            else:
+                status, response_body = 404, {'message': 'Not Found'}
+
+            if method == 'GET' and status == 200:
+                etag = '"{0}"'.format(hashlib.md5(json.dumps(response_body, sort_keys=True).encode()).hexdigest())
+                response_headers['ETag'] = etag
+                if headers.get('If-None-Match') == etag:
+                    return 304, dict(self.get_rate_limit_headers(), **response_headers), None
+            self.rate_limit -= 1
+            response_headers.update(self.get_rate_limit_headers())
+
+        if method == 'POST':
+            return 201, response_headers, self.add(path.rstrip('/'), body or {})
+        return status, response_headers, response_body
+
+    def handle_item(self, method, collection, item_id, body):
+        items = self.collections[collection]
+        for index, item in enumerate(items):
+            if item['id'] == item_id:
+                if method == 'GET':
+                    return 200, item
+                if method == 'PATCH':
+                    item.update(body or {})
+                    return 200, item
+                if method == 'DELETE':
+                    items.pop(index)
+                    return 204, None
+        return 404, {'message': 'Not Found'}
+
+    def get_page(self, collection, query, response_headers):
+        items = self.collections.get(collection, [])
+        per_page = min(int(query.get('per_page', 30)), 100)
+        page = int(query.get('page', 1))
+        links = []
+        if page * per_page < len(items):
+            links.append('<{0}{1}?per_page={2}&page={3}>; rel="next"'.format(self.url, collection, per_page, page + 1))
+        if page > 1:
+            links.append('<{0}{1}?per_page={2}&page={3}>; rel="prev"'.format(self.url, collection, per_page, page - 1))
+        if links:
+            response_headers['Link'] = ', '.join(links)
+        return items[(page - 1) * per_page:page * per_page]
+
+    def get_rate_limit_headers(self):
+        return {
+            'X-RateLimit-Limit': '5000',
+            'X-RateLimit-Remaining': str(max(self.rate_limit, 0)),
+            'X-RateLimit-Reset': str(self.rate_limit_reset),
+        }
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like GitHub.
+
+    def do_request(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw_body = self.rfile.read(length) if length else b''
+        body = json.loads(raw_body.decode('utf-8')) if raw_body else None
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        status, headers, response_body = self.server.github.handle(
+            self.command, url.path, dict(self.headers), body, query)
+        content = json.dumps(response_body).encode() if response_body is not None else b''
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PATCH = do_DELETE = do_request
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,216 @@
+""" Expands a CloudFormation template locally with the Phoenix macro (lambda/macro).
+
+Runs the exact lambda_handler transform logic of the macro Lambda, with the SSM and S3
+clients replaced by local stand-ins:
+  - SSM parameters are read from a JSON/YAML snapshot file.
+  - PhoenixS3Transform files are read from a local directory (the Phoenix directory by default),
+    the same way they are synced to the 'cloudformation' folder of the project bucket.
+
+USAGE:
+  python macro_expand.py {template} {params_file} {ssm_snapshot} [--output {file}]
+      [--includes-dir {dir}] [--project-name {name}] [--benchmark {iterations}] [--strict]
+
+  The params file may be in the codepipeline or cloudformation format (see parameters_generator.py).
+
+  The SSM snapshot may be any of the following:
+    {"/microservice/my-project/global/domain": "example.com", ...}
+    [{"Name": "/microservice/my-project/global/domain", "Value": "example.com", "Type": "String"}, ...]
+    The output of 'aws ssm get-parameters-by-path --path /microservice/my-project/ --recursive --with-decryption'
+
+EXAMPLES:
+  python macro_expand.py template-ec2.json template-ec2-params-testing.json ssm.json --output expanded.json
+  python macro_expand.py template-pipeline.json template-ssm-globals-macro-params.json ssm.yml --benchmark 50
+"""
+
+__author__ = "Jason DeBolt (jasondebolt@gmail.com)"
+
+import os
+import io
+import re
+import sys
+import json
+import copy
+import time
+import hashlib
+import argparse
+import contextlib
+
+PHOENIX_DIR = os.path.dirname(os.path.abspath(__file__))
+MACRO_DIR = os.path.join(PHOENIX_DIR, 'lambda', 'macro')
+TRAILING_COMMA_RE = re.compile(r',(\s*[}\]])')
+
+
+class LocalSSMClient(object):
+    """Stands in for the boto3 SSM client, serving parameters from a snapshot."""
+
+    def __init__(self, params):
+        self.params = {}
+        for param in params:
+            self.params[param['Name']] = {
+                'Name': param['Name'],
+                'Type': param.get('Type', 'String'),
+                'Value': param['Value'],
+                'Version': param.get('Version', 1),
+                'LastModifiedDate': param.get('LastModifiedDate', ''),
+            }
+
+    def get_parameters(self, Names, WithDecryption=False):
+        return {
+            'Parameters': [self.params[name] for name in Names if name in self.params],
+            'InvalidParameters': [name for name in Names if name not in self.params],
+        }
+
+
+class LocalS3Client(object):
+    """Stands in for the boto3 S3 client, serving objects from a local directory.
+
+    The bucket is ignored and the key prefix (the 'cloudformation' folder) is stripped.
+    """
+
+    def __init__(self, root_dir, prefix='cloudformation/'):
+        self.root_dir = root_dir
+        self.prefix = prefix
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        from botocore.exceptions import ClientError
+        path = os.path.join(self.root_dir, Key[len(self.prefix):] if Key.startswith(self.prefix) else Key)
+        try:
+            body = open(path, 'rb').read()
+        except IOError:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': path}}, 'GetObject')
+        etag = '"{0}"'.format(hashlib.md5(body).hexdigest())
+        if IfNoneMatch == etag:
+            raise ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'}}, 'GetObject')
+        return {'ETag': etag, 'Body': io.BytesIO(body), 'ContentLength': len(body)}
+
+
+def load_macro_module(project_name=None):
+    # The macro module reads its project name and creates boto3 clients on import.
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('PHX_MACRO_PROJECT_NAME', project_name or _parse_json(os.path.join(
+        PHOENIX_DIR, 'template-ssm-globals-macro-params.json'))['Parameters']['ProjectName'])
+    # Appended, since parameters_generator.py resolves its files relative to sys.path[0].
+    if MACRO_DIR not in sys.path:
+        sys.path.append(MACRO_DIR)
+    import lambda_function
+    return lambda_function
+
+
+def load_ssm_snapshot(path):
+    if path.endswith('.yml') or path.endswith('.yaml'):
+        try:
+            import yaml
+        except ImportError:
+            raise SystemExit('PyYAML is required for YAML SSM snapshots (pip install pyyaml).')
+        snapshot = yaml.safe_load(open(path, 'r'))
+    else:
+        snapshot = _parse_json(path)
+    if isinstance(snapshot, dict) and isinstance(snapshot.get('Parameters'), list):
+        snapshot = snapshot['Parameters']
+    if isinstance(snapshot, dict):
+        return [{'Name': name, 'Value': str(value)} for name, value in snapshot.items()]
+    return snapshot
+
+
+def load_params(path, template):
+    # CloudFormation passes template parameter defaults to the macro as well.
+    params_map = {key: value['Default']
+                  for key, value in template.get('Parameters', {}).items() if 'Default' in value}
+    params = _parse_json(path)
+    if isinstance(params, list):
+        # The cloudformation format.
+        params_map.update({param['ParameterKey']: param['ParameterValue'] for param in params})
+    else:
+        # The codepipeline format, which may contain PROJECT_NAME placeholders.
+        import parameters_generator
+        params_map.update(json.loads(
+            parameters_generator.convert_parameters_file(params, 'codepipeline'))['Parameters'])
+    return params_map
+
+
+def expand(macro, template, params_map):
+    event = {
+        'requestId': 'local',
+        'region': os.environ['AWS_DEFAULT_REGION'],
+        'accountId': '000000000000',
+        'transformId': 'local',
+        'params': {},
+        'fragment': copy.deepcopy(template),
+        'templateParameterValues': dict(params_map),
+    }
+    # Macro logs go to stderr so stdout can hold the expanded template.
+    with contextlib.redirect_stdout(sys.stderr):
+        return macro.lambda_handler(event, None)
+
+
+def benchmark(macro, template, params_map, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        expand(macro, template, params_map)
+        timings.append(time.perf_counter() - start)
+    return {
+        'iterations': iterations,
+        'cold_ms': round(timings[0] * 1000, 3),
+        'best_ms': round(min(timings) * 1000, 3),
+        'mean_ms': round(sum(timings) / len(timings) * 1000, 3),
+    }
+
+
+def _parse_json(path):
+    result = open(path, 'r').read()
+    try:
+        return json.loads(result)
+    except ValueError:
+        # CloudFormation tolerates trailing commas, which a few templates have.
+        return json.loads(TRAILING_COMMA_RE.sub(r'\1', result))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Expands a CloudFormation template locally with the Phoenix macro.')
+    parser.add_argument('template')
+    parser.add_argument('params_file')
+    parser.add_argument('ssm_snapshot')
+    parser.add_argument('--output', help='Where to write the expanded template. Defaults to stdout.')
+    parser.add_argument('--includes-dir', default=PHOENIX_DIR,
+                        help='Local directory standing in for the cloudformation folder of the project bucket.')
+    parser.add_argument('--project-name', help='Defaults to the ProjectName in template-ssm-globals-macro-params.json.')
+    parser.add_argument('--benchmark', type=int, metavar='ITERATIONS',
+                        help='Expand the template repeatedly and print timings instead of the template.')
+    parser.add_argument('--strict', action='store_true',
+                        help='Exit with an error if any PhoenixSSM value is unresolved.')
+    args = parser.parse_args(args)
+
+    macro = load_macro_module(args.project_name)
+    ssm_params = load_ssm_snapshot(args.ssm_snapshot)
+    # PhoenixS3Transform reads the project bucket name from SSM, which is irrelevant locally.
+    bucket_path = '/microservice/{0}/global/bucket-name'.format(macro.PROJECT_NAME)
+    if bucket_path not in [param['Name'] for param in ssm_params]:
+        ssm_params.append({'Name': bucket_path, 'Value': 'local'})
+    macro.ssm_client = LocalSSMClient(ssm_params)
+    macro.s3_client = LocalS3Client(args.includes_dir)
+
+    template = _parse_json(args.template)
+    params_map = load_params(args.params_file, template)
+
+    if args.benchmark:
+        print(json.dumps(benchmark(macro, template, params_map, args.benchmark)))
+        return
+
+    response = expand(macro, template, params_map)
+    if response['status'] != 'success':
+        raise SystemExit(response['errorMessage'])
+    output = json.dumps(response['fragment'], indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+    for item in response.get('unresolvedPhoenixSSM', []):
+        sys.stderr.write('Unresolved PhoenixSSM value {path}: {reason}\n'.format(**item))
+    if args.strict and response.get('unresolvedPhoenixSSM'):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
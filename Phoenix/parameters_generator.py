@@ -17,19 +17,41 @@ USAGE:
   OR
 
   Use to the temp.json file at a parameter file in a codepipeline deployment action.
+
+BATCH USAGE:
+  python parameters_generator.py batch {cloudformation | codepipeline} {output_dir} [--environments testing,prod]
+      [--components ssm-environments,database] [--files 'template-*-params-*.json']
+      [--replace VERSION_ID=v_1234567] [--workers 4]
+
+  Converts many parameter files in one process. Each component/environment pair reads
+  template-{component}-params-{environment}.json from the Phoenix directory and writes
+  t-{component}-params-{environment}.json to the output directory. Files matched by --files are
+  converted the same way. Environments default to the PipelineEnvironments and ReleaseEnvironments
+  in template-ssm-globals-macro-params.json.
+
+  Each --replace is a plain text substitution applied before parsing, like the sed calls this replaces.
+
+EXAMPLES:
+  python parameters_generator.py batch codepipeline .. --components ec2,lambda --replace VERSION_ID=v_1234567
+  python parameters_generator.py batch cloudformation /tmp/params --files 'template-vpc-params-*.json'
 """
 
 __author__ = "Jason DeBolt (jasondebolt@gmail.com)"
 
-import sys, os, json
+import sys, os, json, glob, argparse, functools
+from concurrent.futures import ThreadPoolExecutor
+
+@functools.lru_cache(maxsize=None)
+def get_global_params():
+    # Read once per process, no matter how many files are converted.
+    return _parse_json('template-ssm-globals-macro-params.json')['Parameters']
 
 def convert_parameters_file(obj, conversion_format='cloudformation'):
     params = obj['Parameters']
     cloudformation_obj = []
     codepipeline_obj = {'Parameters': {}}
 
-    project_name = _parse_json(
-        'template-ssm-globals-macro-params.json')['Parameters']['ProjectName']
+    project_name = get_global_params()['ProjectName']
 
     for param_key in params:
         value = params[param_key]
@@ -56,7 +78,63 @@ def _parse_json(path):
         print('\nYour JSON is not valid! Did you check trailing commas??\n')
         raise(e)
 
+def get_environments():
+    global_params = get_global_params()
+    environments = '{0},{1}'.format(global_params['PipelineEnvironments'], global_params['ReleaseEnvironments'])
+    return [environment for environment in environments.replace(' ', '').split(',') if environment]
+
+def get_batch_files(components, environments, file_patterns, output_dir):
+    """Returns a list of (input_path, output_path) tuples."""
+    input_paths = [os.path.join(sys.path[0], 'template-{0}-params-{1}.json'.format(component, environment))
+                   for environment in environments for component in components]
+    for pattern in file_patterns:
+        input_paths.extend(sorted(glob.glob(os.path.join(sys.path[0], pattern))))
+    return [(input_path, os.path.join(output_dir, 't-' + os.path.basename(input_path)[len('template-'):]))
+            for input_path in input_paths]
+
+def convert_file(input_path, output_path, conversion_format, replacements):
+    result = open(input_path, 'r').read()
+    for old, new in replacements:
+        result = result.replace(old, new)
+    try:
+        obj = json.loads(result)
+    except json.decoder.JSONDecodeError as e:
+        print('\nYour JSON is not valid! Did you check trailing commas?? {0}\n'.format(input_path))
+        raise(e)
+    with open(output_path, 'w') as output_file:
+        output_file.write(convert_parameters_file(obj, conversion_format) + '\n')
+    return output_path
+
+def batch(args):
+    parser = argparse.ArgumentParser(prog='parameters_generator.py batch')
+    parser.add_argument('conversion_format', choices=['cloudformation', 'codepipeline'])
+    parser.add_argument('output_dir')
+    parser.add_argument('--environments', help='Comma separated environment names.')
+    parser.add_argument('--components', default='', help='Comma separated component names, e.g. ec2,lambda')
+    parser.add_argument('--files', action='append', default=[], help='Glob of params files in the Phoenix directory.')
+    parser.add_argument('--replace', action='append', default=[], metavar='OLD=NEW')
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args(args)
+
+    environments = args.environments.split(',') if args.environments else get_environments()
+    components = [component for component in args.components.split(',') if component]
+    replacements = [replacement.split('=', 1) for replacement in args.replace]
+    files = get_batch_files(components, environments, args.files, args.output_dir)
+    missing = [input_path for input_path, _ in files if not os.path.isfile(input_path)]
+    if missing:
+        raise SystemExit('Missing parameter files:\n{0}'.format('\n'.join(missing)))
+    if not files:
+        raise SystemExit('No parameter files to convert!')
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        output_paths = executor.map(
+            lambda paths: convert_file(paths[0], paths[1], args.conversion_format, replacements), files)
+        for (input_path, _), output_path in zip(files, output_paths):
+            print('{0} -> {1}'.format(os.path.basename(input_path), output_path))
+
 def main(args):
+    if args and args[0] == 'batch':
+        return batch(args[1:])
     if len(args) != 2 or args[1] not in ['cloudformation', 'codepipeline']:
         raise SystemExit('Invalid arguments!')
     params_file = args[0]
@@ -1,7 +1,7 @@
 """ Handles CodeBuild jobs executing in the context of a GitHub Pull Request
 
 USAGE:
-  python pull_request_codebuild.py [build | unit-test | lint]
+  python pull_request_codebuild.py [build | unit-test | lint] [pending]
 
   As long as you have the environment variables set as specified in the
   initializer, you can run this script either locally or on AWS CodeBuild.
@@ -13,9 +13,19 @@ USAGE:
 
   This script does the following:
     1) Persists a github.json file that is passed by CodePipeline to a Lambda function.
-    2) Notifies GitHub of the status of AWS CodeBuild jobs.
+    2) Notifies GitHub of the status of AWS CodeBuild jobs. With the 'pending' argument (in the
+       pre_build phase) only the pending status is posted. Otherwise (in the post_build phase)
+       success or failure is posted, depending on CODEBUILD_BUILD_SUCCEEDING. Exits with status 1
+       if any status or check run could not be posted, so that the CodeBuild job fails.
     3) Generates an ECS parameter template specifically for spinning up
        a dev ECS instance used during code review.
+
+  Optional environment variables:
+    REPORT_PHASE_STATUSES=true  Also posts a '{job}/{phase}' status with the duration of each
+                                buildspec phase (install, pre_build, build).
+    GITHUB_CHECKS=true          Posts a single GitHub check run per job instead of statuses, with a
+                                table of the CodeBuild phase timings. The Checks API only accepts
+                                GitHub App installation tokens as GITHUB_ACCESS_TOKEN.
 """
 
 __author__ = "Jason DeBolt (jasondebolt@gmail.com)"
@@ -25,7 +35,12 @@ import urllib
 from urllib.parse import quote
 import sys
 import json
-import requests
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# The GitHub client is shared with the Lambda functions. Appended, since _parse_json reads from sys.path[0].
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lambda', 'shared'))
+from github_client import GitHubClient
 
 # These env variables are passed in via CloudFormation
 PIPELINE_NAME = os.environ.get('PIPELINE_NAME')
@@ -39,6 +54,7 @@ GITHUB_ACCESS_TOKEN = os.environ.get('GITHUB_ACCESS_TOKEN')
 
 # These env variables are always avaialable in AWS CodeBuild
 CODEBUILD_BUILD_ARN = os.environ.get('CODEBUILD_BUILD_ARN')
+CODEBUILD_BUILD_ID = os.environ.get('CODEBUILD_BUILD_ID')
 CODE_BUILD_REGION = os.environ.get('AWS_DEFAULT_REGION')
 CODEBUILD_BUILD_SUCCEEDING = int(os.environ.get('CODEBUILD_BUILD_SUCCEEDING', 0))
 CODEBUILD_RESOLVED_SOURCE_VERSION = os.environ.get('CODEBUILD_RESOLVED_SOURCE_VERSION')
@@ -46,7 +62,16 @@ BUILD_NAME = CODEBUILD_BUILD_ARN.split(':')[-2].split('/')[1]
 BUILD_ID = CODEBUILD_BUILD_ARN.split(':')[-1]
 
 # GitHub vars
-GITHUB_API_URL = 'https://api.github.com'
+github = GitHubClient(GITHUB_ACCESS_TOKEN)
+REPORT_PHASE_STATUSES = os.environ.get('REPORT_PHASE_STATUSES', 'false') == 'true'
+GITHUB_CHECKS = os.environ.get('GITHUB_CHECKS', 'false') == 'true'
+CHECKS_API_ACCEPT = 'application/vnd.github.antiope-preview+json'
+STATUS_DESCRIPTIONS = {
+    'pending': 'The {0} is running.',
+    'success': 'The {0} succeeded!',
+    'failure': 'The {0} failed!',
+}
+BUILDSPEC_PHASES = ('INSTALL', 'PRE_BUILD', 'BUILD')
 
 def get_code_build_url():
     return (
@@ -132,41 +157,136 @@ def _parse_json(path):
         print('\nYour JSON is not valid! Did you check trailing commas??\n')
         raise(e)
 
-def send_status(build_type):
-    # Build can can be 'build', 'lint', 'unit-test', etc.
-    url = os.path.join(
-        GITHUB_API_URL, 'repos/{0}/{1}/statuses/{2}'.format(
-            GITHUB_ORGANIZATION, REPO_NAME,
-            CODEBUILD_RESOLVED_SOURCE_VERSION))
+def get_build_phases():
+    """Returns the CodeBuild phases of this build so far, as (phase, status, duration in seconds)."""
+    import boto3 # Only needed for phase timings.
+    codebuild_client = boto3.client('codebuild')
+    build = codebuild_client.batch_get_builds(ids=[CODEBUILD_BUILD_ID])['builds'][0]
+    phases = []
+    for phase in build.get('phases', []):
+        if 'durationInSeconds' in phase:
+            phases.append((phase['phaseType'], phase.get('phaseStatus', ''), phase['durationInSeconds']))
+        elif 'startTime' in phase:
+            # The phase this script is running in.
+            elapsed = datetime.now(phase['startTime'].tzinfo) - phase['startTime']
+            phases.append((phase['phaseType'], 'IN_PROGRESS', int(elapsed.total_seconds())))
+    return phases
+
+def get_phase_state(phase_status):
+    if phase_status == 'SUCCEEDED':
+        return 'success'
+    if phase_status == 'IN_PROGRESS':
+        return 'pending'
+    return 'failure'
+
+def send_statuses(statuses):
+    """Posts (context, state, description) commit statuses concurrently over the client's session.
+    Returns the contexts that could not be posted."""
+    url = 'repos/{0}/{1}/statuses/{2}'.format(
+        GITHUB_ORGANIZATION, REPO_NAME,
+        CODEBUILD_RESOLVED_SOURCE_VERSION)
+
+    def send_status(status):
+        context, state, description = status
+        payload = {
+            'state': state,
+            'target_url': get_code_build_url(),
+            'description': description,
+            'context': context
+        }
+        return github.post(url, payload)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=len(statuses)) as executor:
+        for (context, state, _), response in zip(statuses, executor.map(send_status, statuses)):
+            if response.status_code >= 300:
+                print('Could not post {0} status for {1}: {2} {3}'.format(
+                    state, context, response.status_code, response.text), file=sys.stderr)
+                failed.append(context)
+            else:
+                print('Posted {0} status for {1}: {2}'.format(state, context, response.status_code))
+    return failed
+
+def send_check_run(build_type, state, phases):
+    """Creates or updates this job's check run, with a table of the phase timings. Returns False if it failed."""
+    check_runs_url = 'repos/{0}/{1}/check-runs'.format(GITHUB_ORGANIZATION, REPO_NAME)
+    now = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
     payload = {
-        'state': 'success',
-        'target_url': get_code_build_url(),
-        'description': 'The {0} succeeded!'.format(build_type),
-        'context': build_type
+        'name': build_type,
+        'details_url': get_code_build_url(),
+        'external_id': BUILD_ID,
     }
-    headers = {'Authorization': 'token {0}'.format(GITHUB_ACCESS_TOKEN)}
-    response = requests.post(url, data=json.dumps(payload), headers=headers)
-    print(response)
-    print(json.dumps(response.json(), indent=2))
+    if state == 'pending':
+        payload.update({'status': 'in_progress', 'started_at': now})
+    else:
+        rows = ['| {0} | {1} | {2}s |'.format(phase, status, duration) for phase, status, duration in phases]
+        payload.update({
+            'status': 'completed',
+            'conclusion': state,
+            'completed_at': now,
+            'output': {
+                'title': STATUS_DESCRIPTIONS[state].format(build_type),
+                'summary': 'Total: {0}s'.format(sum(duration for _, _, duration in phases)),
+                'text': '\n'.join(['| Phase | Status | Duration |', '| --- | --- | --- |'] + rows),
+            },
+        })
+
+    check_runs = []
+    if state != 'pending':
+        # Finds the pending check run this job created in its pre_build phase.
+        response = github.get(
+            'repos/{0}/{1}/commits/{2}/check-runs'.format(
+                GITHUB_ORGANIZATION, REPO_NAME, CODEBUILD_RESOLVED_SOURCE_VERSION),
+            params={'check_name': build_type}, headers={'Accept': CHECKS_API_ACCEPT})
+        if response.status_code == 200:
+            check_runs = [check_run for check_run in response.json()['check_runs']
+                          if check_run.get('external_id') == BUILD_ID]
+    if check_runs:
+        response = github.patch('{0}/{1}'.format(check_runs_url, check_runs[0]['id']), payload,
+                                headers={'Accept': CHECKS_API_ACCEPT})
+    else:
+        payload['head_sha'] = CODEBUILD_RESOLVED_SOURCE_VERSION
+        response = github.post(check_runs_url, payload, headers={'Accept': CHECKS_API_ACCEPT})
+    if response.status_code >= 300:
+        print('Could not post {0} check run for {1}: {2} {3}'.format(
+            state, build_type, response.status_code, response.text), file=sys.stderr)
+        return False
+    print('Posted {0} check run for {1}: {2}'.format(state, build_type, response.status_code))
+    return True
 
+def report(build_type, state):
+    # Build type can be 'build', 'lint', 'unit-test', etc. State can be 'pending', 'success' or 'failure'.
+    # Returns the contexts that could not be posted.
+    if GITHUB_CHECKS:
+        if send_check_run(build_type, state, get_build_phases() if state != 'pending' else []):
+            return []
+        return [build_type]
+    statuses = [(build_type, state, STATUS_DESCRIPTIONS[state].format(build_type))]
+    if REPORT_PHASE_STATUSES and state != 'pending':
+        for phase, status, duration in get_build_phases():
+            if phase in BUILDSPEC_PHASES:
+                statuses.append(('{0}/{1}'.format(build_type, phase.lower()), get_phase_state(status),
+                                 '{0} in {1}s'.format(status.lower(), duration)))
+    return send_statuses(statuses)
+
+def get_final_state():
+    return 'success' if CODEBUILD_BUILD_SUCCEEDING else 'failure'
 
 def onBuildJobCompletion():
-    if CODEBUILD_BUILD_SUCCEEDING:
-        send_status('build')
+    failed = report('build', get_final_state())
     # Save git github.json file
     generate_ssm_params()
     generate_ec2_params()
     generate_lambda_params()
     generate_ecs_task_main_params()
     generate_lambda_github_config()
+    return failed
 
 def onUnitTestJobCompletion():
-    if CODEBUILD_BUILD_SUCCEEDING:
-        send_status('unit-test')
+    return report('unit-test', get_final_state())
 
 def onLintJobCompletion():
-    if CODEBUILD_BUILD_SUCCEEDING:
-        send_status('lint')
+    return report('lint', get_final_state())
 
 if __name__ == '__main__':
     # The github.json file is expected by the Lambda function that runs after pull request ECS container deployments.
@@ -176,8 +296,8 @@ if __name__ == '__main__':
     github_lambda_config_file = open('github.json', 'w')
     github_lambda_config_file.write('')
 
-    if len(sys.argv) != 2:
-        print('You must pass in build, unit-test, or lint as an argument')
+    if len(sys.argv) < 2 or sys.argv[2:] not in ([], ['pending']):
+        print('You must pass in build, unit-test, or lint as an argument, optionally followed by pending')
         sys.exit(0)
     # Any of the three following conditions may be met if this is a non-pull request build.
     if not GITHUB_ORGANIZATION:
@@ -197,18 +317,30 @@ if __name__ == '__main__':
         sys.exit(0)
 
     arg = sys.argv[1]
+    failed = []
 
-    if arg == 'build':
+    if sys.argv[2:] == ['pending']:
+        if arg not in ('build', 'unit-test', 'lint'):
+            print('Unknown argument: {0}'.format(arg))
+            sys.exit(0)
+        print('Reporting {0} as pending'.format(arg))
+        failed = report(arg, 'pending')
+    elif arg == 'build':
         if not PIPELINE_NAME:
             print('PIPELINE_NAME environment variable not set. This might be a non pull-request build.')
             sys.exit(0)
         print('Running onBuildJobCompletion')
-        onBuildJobCompletion()
+        failed = onBuildJobCompletion()
     elif arg == 'unit-test':
         print('Running onUnitTestJobCompletion')
-        onUnitTestJobCompletion()
+        failed = onUnitTestJobCompletion()
     elif arg == 'lint':
         print('Running onLintJobCompletion')
-        onLintJobCompletion()
+        failed = onLintJobCompletion()
     else:
         print('Unknown argument: {0}'.format(arg))
+
+    if failed:
+        # Otherwise a bad token or a missing Checks permission would leave the pull request pending.
+        print('Could not post the GitHub status of {0}'.format(', '.join(failed)), file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,87 @@
+""" Unit tests for the pull request webhook worker.
+
+USAGE:
+  python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import unittest
+import importlib.util
+from unittest import mock
+
+import botocore.exceptions
+
+PHOENIX_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(PHOENIX_DIR, 'lambda', 'pull_request_webhook'), os.path.join(PHOENIX_DIR, 'lambda', 'shared')]
+
+ENVIRONMENT = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'PROJECT_NAME': 'phoenix',
+    'PROJECT_DESCRIPTION': 'Phoenix',
+    'CODE_PIPELINE_BUCKET_NAME': 'pipeline-bucket',
+    'CODE_BUILD_DOCKER_IMAGE': 'image',
+    'CODE_BUILD_SERVICE_ROLE_ARN': 'arn:aws:iam::123456789012:role/codebuild',
+    'CODE_PIPELINE_SERVICE_ROLE_ARN': 'arn:aws:iam::123456789012:role/codepipeline',
+    'LAMBDA_BUCKET_NAME': 'lambda-bucket',
+    'GITHUB_ORGANIZATION': 'org',
+    'IAM_ROLE': 'arn:aws:iam::123456789012:role/cloudformation',
+}
+
+with mock.patch.dict(os.environ, ENVIRONMENT):
+    spec = importlib.util.spec_from_file_location(
+        'pull_request_webhook', os.path.join(PHOENIX_DIR, 'lambda', 'pull_request_webhook', 'lambda_function.py'))
+    pull_request_webhook = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(pull_request_webhook)
+
+JOB = {
+    'repo_name': 'phoenix',
+    'source_branch': 'feature_branch',
+    'pull_request_number': '42',
+    'state': 'open',
+    'delivery_id': None,
+}
+
+
+def client_error(code, message, operation_name):
+    return botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': message}}, operation_name)
+
+
+class WorkerHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        patches = [
+            mock.patch.dict(os.environ, ENVIRONMENT),
+            mock.patch.object(pull_request_webhook, 'cloudformation_client'),
+            mock.patch.object(pull_request_webhook, 'get_microservice_bucket_name', return_value='bucket'),
+            mock.patch.object(pull_request_webhook, 'get_github_access_token', return_value='token'),
+            mock.patch.object(pull_request_webhook, 'get_template_etag', return_value='etag'),
+            mock.patch.object(pull_request_webhook, 'describe_stack'),
+            mock.patch.object(pull_request_webhook, 'notify_github'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.cloudformation_client = pull_request_webhook.cloudformation_client
+        self.event = {'Records': [{'body': pull_request_webhook.json.dumps(JOB)}]}
+
+    def test_failing_create_raises(self):
+        pull_request_webhook.describe_stack.return_value = None
+        self.cloudformation_client.create_stack.side_effect = client_error(
+            'AccessDenied', 'User is not authorized to perform: cloudformation:CreateStack', 'CreateStack')
+
+        with self.assertRaises(botocore.exceptions.ClientError):
+            pull_request_webhook.worker_handler(self.event, None)
+        pull_request_webhook.notify_github.assert_not_called()
+
+    def test_stack_without_updates_is_acknowledged(self):
+        pull_request_webhook.describe_stack.return_value = {'Tags': []}
+        self.cloudformation_client.update_stack.side_effect = client_error(
+            'ValidationError', 'No updates are to be performed.', 'UpdateStack')
+
+        pull_request_webhook.worker_handler(self.event, None)
+        self.cloudformation_client.update_stack.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,102 +1,287 @@
+""" Validates all CloudFormation templates in parallel and prints a consolidated report.
+
+Each template first gets a fast offline check (JSON parsing, resource Types, Ref/Fn::GetAtt/Fn::Sub/DependsOn
+targets, condition names and parameter usage). Templates that fail it are reported without calling AWS, and
+templates whose content hash matches the manifest of the last successful validation are skipped entirely.
+
+Templates larger than the validate-template body limit (51,200 bytes) are uploaded to a shared, reusable
+S3 bucket and validated by URL. The bucket is created once and reused between runs; only the uploaded
+templates are deleted afterwards.
+
+USAGE:
+  python validate_template.py [glob_pattern] [max_workers]
+
+  The upload bucket defaults to 'phx-validate-templates-{account_id}-{region}' and can be overridden with the
+  PHX_VALIDATE_BUCKET environment variable.
+
+  The manifest defaults to '.phx-validate/manifest.json' (cached between CodeBuild builds) and can be
+  overridden with the PHX_VALIDATE_MANIFEST environment variable. Set it to an empty string to validate
+  every template remotely.
+
+EXAMPLES:
+  python validate_template.py
+  python validate_template.py '**/*.json' 16
+  python validate_template.py 'template-api*.json'
+"""
+
+__author__ = "Jason DeBolt (jasondebolt@gmail.com)"
+
+import os
+import re
+import sys
 import glob
-import subprocess
+import json
 import time
-import os
+import uuid
+import hashlib
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_TEMPLATE_BODY_BYTES = 51200
+DEFAULT_GLOB_PATTERN = '**/*.json'
+DEFAULT_MAX_WORKERS = 8
+MANIFEST_PATH = os.environ.get('PHX_VALIDATE_MANIFEST', '.phx-validate/manifest.json')
+
+RESOURCE_TYPE_RE = re.compile(
+    r'^(AWS|Alexa)::[A-Za-z0-9]+::[A-Za-z0-9]+(::[A-Za-z0-9]+)?$|^Custom::[A-Za-z0-9_@-]+$')
+PARAMETER_TYPE_RE = re.compile(
+    r'^(String|Number|List<Number>|CommaDelimitedList|(List<)?AWS::[A-Za-z0-9:]+(::Id|::Name|::KeyName)?>?|'
+    r'AWS::SSM::Parameter::Value<.+>)$')
+PSEUDO_PARAMETERS = {'AWS::AccountId', 'AWS::NotificationARNs', 'AWS::NoValue', 'AWS::Partition',
+                     'AWS::Region', 'AWS::StackId', 'AWS::StackName', 'AWS::URLSuffix'}
+SUB_VARIABLE_RE = re.compile(r'\$\{([^!}][^}]*)\}')
+# PhoenixSSM paths reference template parameters as {ParameterName}, see lambda/macro.
+PHOENIX_SSM_PARAMETER_RE = re.compile(r'\{([A-Za-z0-9]+)\}')
+TRAILING_COMMA_RE = re.compile(r',(\s*[}\]])')
+
+# validate-template is throttled quite aggressively, so let botocore back off and retry.
+boto_config = Config(retries={'max_attempts': 10})
+cfn_client = boto3.client('cloudformation', config=boto_config)
+s3_client = boto3.client('s3', config=boto_config)
+sts_client = boto3.client('sts')
+
+
+def get_upload_bucket():
+    """Returns the shared upload bucket for large templates, creating it if it does not exist yet."""
+    region = s3_client.meta.region_name
+    bucket = os.environ.get('PHX_VALIDATE_BUCKET') or 'phx-validate-templates-{0}-{1}'.format(
+        sts_client.get_caller_identity()['Account'], region)
+    try:
+        s3_client.head_bucket(Bucket=bucket)
+    except ClientError:
+        print('Creating template upload bucket {0}'.format(bucket))
+        if region == 'us-east-1':
+            s3_client.create_bucket(Bucket=bucket)
+        else:
+            s3_client.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': region})
+        s3_client.get_waiter('bucket_exists').wait(Bucket=bucket)
+    return bucket
+
+
+def parse_template(body):
+    try:
+        return json.loads(body)
+    except ValueError:
+        # CloudFormation tolerates trailing commas, which a few templates have.
+        return json.loads(TRAILING_COMMA_RE.sub(r'\1', body))
+
+
+def check_template_structure(template):
+    """Runs a fast offline check of a parsed template. Returns a list of errors and a list of warnings."""
+    if not isinstance(template, dict) or not isinstance(template.get('Resources'), dict) \
+            or not template['Resources']:
+        return ['Template has no Resources section'], []
 
+    errors = []
+    parameters = template.get('Parameters', {})
+    resources = template['Resources']
+    conditions = template.get('Conditions', {})
+    used_parameters = set()
 
-def infra_status(cmd, status):
-    if status != 0:
-        text = 'Error: Running \n{0}\n '.format(cmd)
-        print(text)
-        exit(0)
+    for name, parameter in parameters.items():
+        if not PARAMETER_TYPE_RE.match(str(parameter.get('Type', ''))):
+            errors.append('Parameter {0} has an invalid Type: {1}'.format(name, parameter.get('Type')))
 
-def make_bucket(bucket):
-    """Check if the bucket already exists, if not then create it"""
-    ret = subprocess.call(['aws', 's3', 'ls', 's3://{0}'.format(bucket)])
+    for name, resource in resources.items():
+        if not isinstance(resource, dict):
+            errors.append('Resource {0} is not an object'.format(name))
+        elif 'PhoenixS3Transform' in resource:
+            # The whole resource is included from S3 by the macro.
+            continue
+        elif not RESOURCE_TYPE_RE.match(str(resource.get('Type', ''))):
+            errors.append('Resource {0} has an invalid Type: {1}'.format(name, resource.get('Type')))
+        else:
+            depends_on = resource.get('DependsOn', [])
+            for target in depends_on if isinstance(depends_on, list) else [depends_on]:
+                if target not in resources:
+                    errors.append('Resource {0} depends on unknown resource {1}'.format(name, target))
+            if 'Condition' in resource and resource['Condition'] not in conditions:
+                errors.append('Resource {0} uses unknown condition {1}'.format(name, resource['Condition']))
 
-    if ret != 0:
-      subprocess.call(['aws', 's3', 'mb', 's3://{0}'.format(bucket)])
+    def check_ref(target, context, local_names=()):
+        if target in parameters:
+            used_parameters.add(target)
+        elif target not in resources and target not in PSEUDO_PARAMETERS and target not in local_names:
+            errors.append('{0} references unknown parameter or resource {1}'.format(context, target))
 
-def main():
+    # Walk everything except the Parameters section, looking for intrinsic function references.
+    stack = []
+    for section, value in template.items():
+        if section in ('Resources', 'Conditions', 'Outputs') and isinstance(value, dict):
+            stack.extend(('{0}.{1}'.format(section, name), item) for name, item in value.items())
+        elif section != 'Parameters':
+            stack.append((section, value))
+    while stack:
+        context, node = stack.pop()
+        if isinstance(node, list):
+            stack.extend((context, item) for item in node)
+            continue
+        if not isinstance(node, dict):
+            continue
+        for key, value in node.items():
+            if key == 'Ref' and isinstance(value, str):
+                check_ref(value, context)
+            elif key == 'Fn::GetAtt':
+                target = value.split('.')[0] if isinstance(value, str) else value[0] if value else None
+                if isinstance(target, str) and target not in resources:
+                    errors.append('{0} gets an attribute of unknown resource {1}'.format(context, target))
+            elif key == 'Fn::Sub':
+                text, local_names = (value[0], value[1]) if isinstance(value, list) else (value, {})
+                for variable in SUB_VARIABLE_RE.findall(text) if isinstance(text, str) else []:
+                    check_ref(variable.split('.')[0], context, local_names)
+            elif key == 'Fn::If' and isinstance(value, list) and value and value[0] not in conditions:
+                errors.append('{0} uses unknown condition {1}'.format(context, value[0]))
+            elif key == 'PhoenixSSM' and isinstance(value, str):
+                used_parameters.update(PHOENIX_SSM_PARAMETER_RE.findall(value))
+            stack.append((context, value))
+
+    warnings = ['Parameter {0} is never used'.format(name) for name in parameters if name not in used_parameters]
+    return errors, warnings
+
+
+def load_manifest():
+    """Returns a map of file paths to the SHA256 hashes of their last successfully validated content."""
+    try:
+        return json.loads(open(MANIFEST_PATH, 'r').read())
+    except (IOError, ValueError):
+        return {}
+
+
+def save_manifest(manifest):
+    if os.path.dirname(MANIFEST_PATH) and not os.path.isdir(os.path.dirname(MANIFEST_PATH)):
+        os.makedirs(os.path.dirname(MANIFEST_PATH))
+    with open(MANIFEST_PATH, 'w') as manifest_file:
+        manifest_file.write(json.dumps(manifest, indent=2, sort_keys=True))
+
+
+def check_file(file_path, manifest):
+    """Runs the offline checks on a file. Returns a result, with a status of None if it still needs a remote check."""
+    start = time.time()
+    body = open(file_path, 'rb').read()
+    result = {'file': file_path, 'bytes': len(body), 'sha256': hashlib.sha256(body).hexdigest(), 'body': body,
+              'status': None, 'check': 'offline', 'warnings': [], 's3_key': None}
+    if manifest.get(file_path) == result['sha256']:
+        result['status'] = 'CACHED'
+    else:
+        try:
+            errors, result['warnings'] = check_template_structure(parse_template(body.decode('utf-8')))
+        except ValueError as e:
+            errors = ['Invalid JSON: {0}'.format(e)]
+        if errors:
+            result['status'] = 'INVALID'
+            # The same broken reference is usually repeated, so only report it once.
+            result['error'] = '\n  '.join(sorted(set(errors), key=errors.index))
+    result['latency_ms'] = int((time.time() - start) * 1000)
+    return result
+
+
+def validate_file(result, bucket, key_prefix):
+    start = time.time()
+    result['check'] = 'remote'
+    try:
+        if result['bytes'] > MAX_TEMPLATE_BODY_BYTES:
+            key = '{0}/{1}'.format(key_prefix, result['file'].replace(os.sep, '/'))
+            s3_client.put_object(Bucket=bucket, Key=key, Body=result['body'])
+            result['s3_key'] = key
+            cfn_client.validate_template(TemplateURL='https://{0}.s3.amazonaws.com/{1}'.format(bucket, key))
+        else:
+            cfn_client.validate_template(TemplateBody=result['body'].decode('utf-8'))
+        result['status'] = 'VALID'
+    except ClientError as e:
+        result['status'] = 'INVALID'
+        result['error'] = e.response['Error'].get('Message', str(e))
+    except Exception as e:
+        result['status'] = 'ERROR'
+        result['error'] = '{0}: {1}'.format(type(e).__name__, e)
+    result['latency_ms'] += int((time.time() - start) * 1000)
+    return result
+
+
+def delete_uploads(bucket, keys):
+    # delete_objects accepts at most 1000 keys per call.
+    for i in range(0, len(keys), 1000):
+        s3_client.delete_objects(Bucket=bucket, Delete={
+            'Objects': [{'Key': key} for key in keys[i:i + 1000]], 'Quiet': True})
+
+
+def print_report(results, elapsed):
+    print('\n{0:<8} {1:<8} {2:>8} {3:>10}  {4}'.format('STATUS', 'CHECK', 'BYTES', 'LATENCY', 'FILE'))
+    for result in results:
+        print('{0:<8} {1:<8} {2:>8} {3:>8}ms  {4}{5}'.format(
+            result['status'], result['check'], result['bytes'], result['latency_ms'], result['file'],
+            ' (via S3)' if result['s3_key'] else ''))
+    for result in results:
+        for warning in result['warnings']:
+            print('WARNING {0}: {1}'.format(result['file'], warning))
+    failed = [result for result in results if result['status'] not in ('VALID', 'CACHED')]
+    for result in failed:
+        print('\n{0} {1}:\n  {2}'.format(result['status'], result['file'], result['error']))
+    print('\nChecked {0} templates in {1:.1f}s: {2} unchanged since their last successful validation, '
+          '{3} validated remotely, {4} failed.'.format(
+              len(results), elapsed, len([result for result in results if result['status'] == 'CACHED']),
+              len([result for result in results if result['check'] == 'remote']), len(failed)))
+    return failed
+
+
+def main(args):
     """
-    Iterate over all cloud formation templates running validate command against them
-    TODO: Stretch fork the validation into it's own process to make it faster... wait until they are all done and generate a nice report
+    Iterate over all cloud formation templates running validate against them with a pool of workers,
+    wait until they are all done and generate a report.
     """
-    for file_path in glob.iglob('**/*.json'):
-        if "params" not in file_path:
-            print('Validating file: {0}'.format(file_path))
-
-            try:
-               result = subprocess.call([
-                   'aws',
-                   'cloudformation', 'validate-template', '--template-body',
-                   'file://{0}'.format(file_path)
-               ])
-               if result != 0:
-                 # If this valdate throughs as expection it is caught but if it just puts and error
-                 # in the output then we have false positives. That is why I have the one about.
-                 # I feel my logic is flawed.
-                 subprocess.check_output([
-                    'aws',
-                    'cloudformation', 'validate-template', '--template-body',
-                    'file://{0}'.format(file_path)
-                    ], stderr=subprocess.STDOUT)
-
-            except subprocess.CalledProcessError as e:
-                output = str(e.output)
-
-                # If the template body is too large, it will throw an error, so instead we will need to first upload
-                # the file to s3 and then validate it from there.
-                if 'Member must have length less than or equal to 51200' in output:
-                    print('File {0} is too large, uploading to s3 for validation'.format(file_path))
-
-                    timestamp = str(time.time())
-                    abs_path = os.path.abspath(file_path)
-                    s3_file_name = timestamp.split('.')[0] + '-' + os.path.basename(abs_path)
-                    bucket = 'infratemp' + timestamp.split('.')[0]
-
-                    make_bucket(bucket)
-                    s3_path = '{0}/{1}'.format(bucket, s3_file_name)
-
-                # upload the file
-                    ret = subprocess.call(['aws', 's3', 'cp', os.path.abspath(file_path), 's3://{0}'.format(s3_path)])
-                    cmd = 'aws s3 cp {0} s3://{1}'.format(os.path.abspath(file_path), s3_path )
-                    infra_status(cmd, ret)
-
-                    # validate the file
-                    result = subprocess.call([
-                        'aws',
-                        'cloudformation', 'validate-template', '--template-url',
-                        'https://s3.amazonaws.com/{0}'.format(s3_path)
-                    ])
-
-                    # delete the file
-                    ret = subprocess.call(['aws', 's3', 'rm', 's3://{0}'.format(s3_path)])
-                    cmd =  'aws s3 rm s3://{0}'.format( s3_path )
-                    infra_status( cmd, ret)
-
-                    # delete the bucket
-                    ret = subprocess.call(['aws', 's3', 'rb', '--force', 's3://{0}'.format(bucket)])
-                    cmd =  'aws s3 rb --force s3://{0}'.format( bucket )
-                    infra_status( cmd, ret)
-
-
-                    if result != 0:
-                        text = 'Validation failed! aws cloudformation validate-template --template-url https://s3.amazonaws.com/{0}'.format(s3_path)
-                        print(text)
-                        exit(1)
-
-            except : #need to catch other exceptions
-                text = 'Exception: Validation failed! aws cloudformation validate-template --template-body file://{0}'.format(file_path)
-                print(text)
-                exit(1)
-            if result != 0:
-                text = 'Exception: Validation failed! aws cloudformation validate-template --template-body file://{0}'.format(file_path)
-                print(text)
-                exit(1)
+    pattern = args[0] if len(args) > 0 else DEFAULT_GLOB_PATTERN
+    max_workers = int(args[1]) if len(args) > 1 else DEFAULT_MAX_WORKERS
+    file_paths = sorted(path for path in glob.iglob(pattern) if 'params' not in path)
+    key_prefix = 'validate-template/{0}'.format(uuid.uuid4().hex)
+
+    manifest = load_manifest() if MANIFEST_PATH else {}
+
+    print('Validating {0} templates with {1} workers'.format(len(file_paths), max_workers))
+    start = time.time()
+    # Unchanged templates are skipped and structurally broken ones fail without calling AWS.
+    results = [check_file(path, manifest) for path in file_paths]
+    remote_results = [result for result in results if result['status'] is None]
+    # Only look up (or create) the upload bucket if a large template needs it.
+    bucket = None
+    if [result for result in remote_results if result['bytes'] > MAX_TEMPLATE_BODY_BYTES]:
+        bucket = get_upload_bucket()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda result: validate_file(result, bucket, key_prefix), remote_results))
+
+    uploaded_keys = [result['s3_key'] for result in results if result['s3_key']]
+    if uploaded_keys:
+        delete_uploads(bucket, uploaded_keys)
+    if MANIFEST_PATH:
+        save_manifest({result['file']: result['sha256'] for result in results
+                       if result['status'] in ('VALID', 'CACHED')})
 
+    failed = print_report(results, time.time() - start)
+    if failed:
+        print('\n\nValidation failed!\n\n')
+        sys.exit(1)
     print('\n\nAll cloudformation have valid syntax. Nice job you ROCK!!\n\n')
 
 
 if __name__ == "__main__":
-    main()
+    main(sys.argv[1:])